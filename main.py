@@ -4,8 +4,12 @@
 EDUKY-商品监控系统
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, Response, make_response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 from datetime import datetime, timedelta, timezone
 import requests
 import json
@@ -14,12 +18,34 @@ import time
 from apscheduler.schedulers.background import BackgroundScheduler
 import logging
 import os
+import re
+import math
+import random
+import zlib
 import sqlite3
-from threading import Lock
+import queue
+import gzip
+import io
+import string
+from threading import Lock, BoundedSemaphore
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from itertools import zip_longest
+from collections import namedtuple, deque
+from requests.adapters import HTTPAdapter
+from lxml import etree
+import lxml.html
+import numpy as np
+try:
+    from cssselect import HTMLTranslator, SelectorError
+except ImportError:  # 未安装 cssselect 时全部使用 BeautifulSoup 解析
+    HTMLTranslator = None
+    SelectorError = Exception
 import pytz
 import ntplib
 import hashlib
-from functools import wraps
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 
 # 配置日志
 logging.basicConfig(
@@ -53,8 +79,27 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 
 db = SQLAlchemy(app)
 
-# 数据库锁
-db_lock = Lock()
+# SQLite 连接参数：WAL 模式下读写互不阻塞，写入者之间由 busy timeout 排队
+SQLITE_PRAGMAS = (
+    ('auto_vacuum', 'INCREMENTAL'),  # 需在建表前设置，仅对新建数据库生效，已有数据库由迁移转换
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),      # WAL 模式下只在检查点时 fsync
+    ('cache_size', -16000),         # 16MB 页缓存
+    ('mmap_size', 64 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新连接设置 SQLite 参数"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
 
 # 时区设置
 CHINA_TZ = pytz.timezone('Asia/Shanghai')
@@ -68,23 +113,99 @@ NTP_SERVERS = [
     'ntp.ntsc.ac.cn'
 ]
 
-def get_internet_time():
-    """获取互联网时间 (中国时区)"""
-    for server in NTP_SERVERS:
-        try:
-            ntp_client = ntplib.NTPClient()
-            response = ntp_client.request(server, version=3, timeout=5)
-            utc_time = datetime.fromtimestamp(response.tx_time, tz=timezone.utc)
-            china_time = utc_time.astimezone(CHINA_TZ)
-            logger.info(f"成功从NTP服务器 {server} 获取时间: {china_time}")
-            return china_time
-        except Exception as e:
-            logger.warning(f"从NTP服务器 {server} 获取时间失败: {e}")
-            continue
+# 时间同步间隔（秒）：成功后每小时校准一次，失败后5分钟重试
+CLOCK_SYNC_INTERVAL = 3600
+CLOCK_RETRY_INTERVAL = 300
+
+class ClockService:
+    """时钟服务：后台与NTP服务器同步，记录与本地时钟的偏差
     
-    # 如果所有NTP服务器都失败，使用本地时间作为备用
-    logger.warning("所有NTP服务器都不可用，使用本地时间")
-    return datetime.now(CHINA_TZ)
+    取当前时间时只做本地计算（单调时钟 + 偏差），不会在监控流程中等待网络。
+    """
+    def __init__(self, servers):
+        self.servers = servers
+        self._lock = Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        # 基准点：同步时刻的校准后时间戳与对应的单调时钟读数
+        self._base_time = time.time()
+        self._base_monotonic = time.monotonic()
+        self.offset = 0.0
+        self.drift = None
+        self.synced = False
+        self.server = None
+        self.last_sync = None
+        self.last_attempt = None
+        self.last_error = None
+
+    def _timestamp(self):
+        return self._base_time + (time.monotonic() - self._base_monotonic)
+
+    def now(self):
+        """当前时间 (中国时区)"""
+        with self._lock:
+            timestamp = self._timestamp()
+        return datetime.fromtimestamp(timestamp, tz=CHINA_TZ)
+
+    def sync(self):
+        """依次尝试NTP服务器，成功后更新时钟偏差，返回是否同步成功"""
+        self.last_attempt = datetime.now(CHINA_TZ)
+        for server in self.servers:
+            try:
+                ntp_client = ntplib.NTPClient()
+                response = ntp_client.request(server, version=3, timeout=5)
+            except Exception as e:
+                logger.warning(f"从NTP服务器 {server} 获取时间失败: {e}")
+                self.last_error = str(e)
+                continue
+            
+            with self._lock:
+                # 本次同步前时钟与NTP时间的差值，即上次同步以来累计的漂移
+                drift = (time.time() + response.offset) - self._timestamp()
+                self._base_monotonic = time.monotonic()
+                self._base_time = time.time() + response.offset
+                self.drift = drift if self.synced else None
+                self.offset = response.offset
+                self.synced = True
+                self.server = server
+                self.last_sync = datetime.fromtimestamp(self._base_time, tz=CHINA_TZ)
+                self.last_error = None
+            logger.info(f"成功从NTP服务器 {server} 同步时间，本地时钟偏差 {response.offset:+.3f} 秒")
+            return True
+        
+        # 所有服务器都失败时保留上次的偏差，从未同步过则使用本地时间
+        logger.warning("所有NTP服务器都不可用，" + ("沿用上次同步的时间偏差" if self.synced else "使用本地时间"))
+        return False
+
+    def status(self):
+        """同步状态"""
+        return {
+            'synced': self.synced,
+            'server': self.server,
+            'offset_seconds': round(self.offset, 3),
+            'drift_seconds': round(self.drift, 3) if self.drift is not None else None,
+            'last_sync': self.last_sync.isoformat() if self.last_sync else None,
+            'last_attempt': self.last_attempt.isoformat() if self.last_attempt else None,
+            'last_error': self.last_error
+        }
+
+    def _run(self):
+        while True:
+            success = self.sync()
+            self._wakeup.wait(CLOCK_SYNC_INTERVAL if success else CLOCK_RETRY_INTERVAL)
+            self._wakeup.clear()
+
+    def start(self):
+        """启动后台同步线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='clock-sync', daemon=True)
+            self._thread.start()
+
+clock = ClockService(NTP_SERVERS)
+
+def get_internet_time():
+    """获取互联网时间 (中国时区)，由后台同步的时钟服务提供，不阻塞"""
+    return clock.now()
 
 def utc_to_china_time(utc_time):
     """将UTC时间转换为中国时间"""
@@ -103,6 +224,42 @@ def db_time_to_china_time(db_time):
         return CHINA_TZ.localize(db_time)
     return db_time.astimezone(CHINA_TZ)
 
+# 并发检测配置
+DEFAULT_FETCH_CONCURRENCY = 5
+MAX_FETCH_CONCURRENCY = 32
+
+# 站点礼貌访问配置
+DEFAULT_PER_HOST_CONCURRENCY = 2   # 单个站点同时进行的请求数
+MAX_PER_HOST_CONCURRENCY = 16
+DEFAULT_PER_HOST_INTERVAL = 1.0    # 同一站点两次请求之间的最小间隔（秒）
+MAX_PER_HOST_INTERVAL = 60.0
+
+# 检测间隔配置
+MIN_CHECK_INTERVAL = 10
+MAX_CHECK_INTERVAL = 3600
+SCHEDULER_TICK_SECONDS = 10      # 调度器检查到期商品的频率（秒）
+ADAPTIVE_STABLE_RATIO = 0.1      # 有效检测间隔 = 库存稳定时长 × 该比例（限制在上下限之间）
+ADAPTIVE_MAX_MULTIPLIER = 10     # 未设置上限时，上限 = 下限 × 该倍数
+
+# 日志保留配置（天，0 表示永久保留）
+DEFAULT_HISTORY_RETENTION_DAYS = 30
+DEFAULT_NOTIFICATION_RETENTION_DAYS = 7
+MAX_RETENTION_DAYS = 3650
+RETENTION_JOB_INTERVAL = 3600     # 清理任务执行频率（秒）
+PRUNE_CHUNK_SIZE = 1000           # 每次删除的记录数
+PRUNE_CHUNK_PAUSE = 0.05          # 两次删除之间让出数据库的时间（秒）
+VACUUM_CHUNK_PAGES = 1000         # 每次增量回收的页数
+
+# 汇总通知配置（窗口内同一聊天的补货、销售通知合并为一条消息）
+DEFAULT_DIGEST_WINDOW = 10        # 汇总窗口（秒），从聊天的第一条待发送通知开始计算
+MAX_DIGEST_WINDOW = 600
+
+# 默认通知模板
+DEFAULT_NOTIFICATION_TEMPLATES = {
+    'restock': "🎉 补货通知\n📦 商品名称: {product_name}\n📈 补货数量: {stock_difference}\n📊 当前库存: {current_stock}",
+    'sale': "🎉 销售通知\n📦 商品名称: {product_name}\n📈 被购买: {stock_difference}\n📊 剩余库存: {current_stock}",
+}
+
 # 数据模型
 class Product(db.Model):
     """商品模型"""
@@ -122,6 +279,18 @@ class Product(db.Model):
     
     # 添加版本控制字段
     version = db.Column(db.Integer, default=1)
+    
+    # 条件请求缓存（ETag / Last-Modified）与页面内容哈希，内容未变化时跳过解析和写库
+    etag = db.Column(db.String(200))
+    last_modified = db.Column(db.String(100))
+    content_hash = db.Column(db.String(64))
+    
+    # 是否需要下载完整页面（关闭后按流式解析，找到库存元素即停止下载）
+    needs_full_document = db.Column(db.Boolean, default=False)
+    
+    # 自适应检测间隔上下限（秒），为空时使用全局检测间隔推算
+    min_interval = db.Column(db.Integer)
+    max_interval = db.Column(db.Integer)
 
 class NotificationConfig(db.Model):
     """通知配置模型"""
@@ -149,13 +318,28 @@ class NotificationConfig(db.Model):
     # 检测间隔设置
     check_interval = db.Column(db.Integer, default=120)  # 默认120秒
     
+    # 并发检测设置（同时进行的商品检测数量，1 表示逐个检测）
+    fetch_concurrency = db.Column(db.Integer, default=DEFAULT_FETCH_CONCURRENCY)
+    
+    # 站点礼貌访问设置（单站点并发上限、同站点请求最小间隔秒数）
+    per_host_concurrency = db.Column(db.Integer, default=DEFAULT_PER_HOST_CONCURRENCY)
+    per_host_interval = db.Column(db.Float, default=DEFAULT_PER_HOST_INTERVAL)
+    
+    # 日志保留天数（库存历史、通知记录），0 表示永久保留
+    history_retention_days = db.Column(db.Integer, default=DEFAULT_HISTORY_RETENTION_DAYS)
+    notification_retention_days = db.Column(db.Integer, default=DEFAULT_NOTIFICATION_RETENTION_DAYS)
+    
+    # 汇总通知：开启后窗口内的通知合并为一条消息发送（通知日志仍逐条记录）
+    digest_enabled = db.Column(db.Boolean, default=False)
+    digest_window = db.Column(db.Integer, default=DEFAULT_DIGEST_WINDOW)
+    
     # 通知类型开关
     restock_enabled = db.Column(db.Boolean, default=True)
     sale_enabled = db.Column(db.Boolean, default=True)
     
     # 通知模板配置
-    template_restock = db.Column(db.Text, default="🎉 补货通知\n📦 商品名称: {product_name}\n📈 补货数量: {stock_difference}\n📊 当前库存: {current_stock}")
-    template_sale = db.Column(db.Text, default="🎉 销售通知\n📦 商品名称: {product_name}\n📈 被购买: {stock_difference}\n📊 剩余库存: {current_stock}")
+    template_restock = db.Column(db.Text, default=DEFAULT_NOTIFICATION_TEMPLATES['restock'])
+    template_sale = db.Column(db.Text, default=DEFAULT_NOTIFICATION_TEMPLATES['sale'])
     
     created_at = db.Column(db.DateTime, default=lambda: get_internet_time().replace(tzinfo=None))
     updated_at = db.Column(db.DateTime, default=lambda: get_internet_time().replace(tzinfo=None))
@@ -172,6 +356,73 @@ class StockHistory(db.Model):
     change_type = db.Column(db.String(20))  # increase, decrease
     
     product = db.relationship('Product', backref=db.backref('stock_histories', lazy=True))
+    
+    __table_args__ = (
+        db.Index('ix_stock_histories_product_timestamp', 'product_id', 'timestamp'),
+        db.Index('ix_stock_histories_timestamp', 'timestamp'),
+    )
+
+class StockRollup(db.Model):
+    """库存历史汇总（按小时、按天），用于长时间范围的图表"""
+    __tablename__ = 'stock_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    resolution = db.Column(db.String(10), nullable=False)  # hour, day
+    bucket_start = db.Column(db.DateTime, nullable=False)  # 时间段起点（中国时间）
+    open_stock = db.Column(db.Integer, nullable=False)     # 时间段内第一次变化前的库存
+    close_stock = db.Column(db.Integer, nullable=False)    # 时间段内最后一次变化后的库存
+    min_stock = db.Column(db.Integer, nullable=False)
+    max_stock = db.Column(db.Integer, nullable=False)
+    restock_units = db.Column(db.Integer, nullable=False, default=0)  # 补货数量合计
+    sold_units = db.Column(db.Integer, nullable=False, default=0)     # 售出数量合计
+    change_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'resolution', 'bucket_start', name='uq_stock_rollups_bucket'),
+    )
+
+# 汇总粒度 -> 时间段起点
+ROLLUP_RESOLUTIONS = {
+    'hour': lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+    'day': lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+# 汇总粒度 -> 时间段起点在 SQLite 中的格式（与 ORM 写入 DateTime 的文本一致，实时累加时才能命中同一行）
+ROLLUP_BUCKET_FORMATS = {
+    'hour': '%Y-%m-%d %H:00:00.000000',
+    'day': '%Y-%m-%d 00:00:00.000000',
+}
+
+def record_stock_rollups(product_id, old_stock, new_stock, timestamp, conn=None):
+    """把一次库存变化累加到各粒度的汇总中（与库存更新在同一事务）"""
+    difference = new_stock - old_stock
+    for resolution, bucket in ROLLUP_RESOLUTIONS.items():
+        stmt = sqlite_insert(StockRollup).values(
+            product_id=product_id,
+            resolution=resolution,
+            bucket_start=bucket(timestamp),
+            open_stock=old_stock,
+            close_stock=new_stock,
+            min_stock=min(old_stock, new_stock),
+            max_stock=max(old_stock, new_stock),
+            restock_units=max(difference, 0),
+            sold_units=max(-difference, 0),
+            change_count=1
+        )
+        # 时间段已存在时：开盘库存不变，收盘库存取本次，其余累加或取极值
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['product_id', 'resolution', 'bucket_start'],
+            set_={
+                'close_stock': stmt.excluded.close_stock,
+                'min_stock': db.func.min(StockRollup.min_stock, stmt.excluded.min_stock),
+                'max_stock': db.func.max(StockRollup.max_stock, stmt.excluded.max_stock),
+                'restock_units': StockRollup.restock_units + stmt.excluded.restock_units,
+                'sold_units': StockRollup.sold_units + stmt.excluded.sold_units,
+                'change_count': StockRollup.change_count + 1
+            }
+        )
+        (conn or db.session).execute(stmt)
 
 class NotificationLog(db.Model):
     """通知日志"""
@@ -185,6 +436,81 @@ class NotificationLog(db.Model):
     timestamp = db.Column(db.DateTime, default=lambda: get_internet_time().replace(tzinfo=None))
     
     product = db.relationship('Product', backref=db.backref('notification_logs', lazy=True))
+    
+    __table_args__ = (
+        db.Index('ix_notification_logs_product_timestamp', 'product_id', 'timestamp'),
+        db.Index('ix_notification_logs_timestamp', 'timestamp'),
+    )
+
+class Event(db.Model):
+    """事件日志（只追加）：库存变化、通知发送等各环节的记录，按序号倒序即为时间倒序"""
+    __tablename__ = 'events'
+    
+    id = db.Column(db.Integer, primary_key=True)  # 自增序号，不会复用
+    event_type = db.Column(db.String(30), nullable=False)  # stock_change, notification
+    product_id = db.Column(db.Integer)  # 商品删除后保留事件，不设外键
+    product_name = db.Column(db.String(200))  # 写入时的商品名称
+    level = db.Column(db.String(10), nullable=False, default='info')  # info, success, warning, error
+    message = db.Column(db.String(200), nullable=False)
+    details = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=lambda: get_internet_time().replace(tzinfo=None))
+    
+    __table_args__ = (
+        db.Index('ix_events_product_id', 'product_id', 'id'),
+        db.Index('ix_events_timestamp', 'timestamp'),
+        {'sqlite_autoincrement': True},
+    )
+
+class NotificationOutbox(db.Model):
+    """通知发件箱：每条通知在每个聊天各一行，发送成功或确定失败前一直保留，重启后继续发送"""
+    __tablename__ = 'notification_outbox'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(32), nullable=False)  # 同一次通知发往各聊天的记录共用
+    product_id = db.Column(db.Integer)
+    product_name = db.Column(db.String(200))
+    notification_type = db.Column(db.String(50), nullable=False)
+    chat_id = db.Column(db.String(100), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    reply_markup = db.Column(db.Text)  # 内联按钮 JSON
+    digest = db.Column(db.Boolean, nullable=False, default=False)  # 到期时与同一聊天的其他汇总记录合并发送
+    summary = db.Column(db.String(500))  # 汇总消息中的一行
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=lambda: get_internet_time().replace(tzinfo=None))
+    sent_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_notification_outbox_status_next', 'status', 'next_attempt_at'),
+        db.Index('ix_notification_outbox_job_id', 'job_id'),
+    )
+
+def stock_change_event(product_id, product_name, old_stock, new_stock, timestamp=None):
+    """库存变化事件"""
+    stock_difference = new_stock - old_stock
+    if stock_difference > 0:
+        level, message = 'success', f'库存补货: +{stock_difference} 件'
+    elif stock_difference < 0:
+        level, message = 'warning', f'库存减少: -{abs(stock_difference)} 件'
+    else:
+        level, message = 'info', f'库存变化: {stock_difference:+d} 件'
+    return Event(event_type='stock_change', product_id=product_id, product_name=product_name,
+                 level=level, message=message, details=f'库存变化: {old_stock} → {new_stock}', timestamp=timestamp)
+
+def notification_event(product_id, product_name, notification_type, status, message, timestamp=None):
+    """通知发送事件"""
+    if status == 'sent':
+        level, summary = 'success', f'{notification_type} 通知发送成功'
+    elif status == 'failed':
+        level, summary = 'error', f'{notification_type} 通知发送失败'
+    elif status == 'error':
+        level, summary = 'error', f'{notification_type} 通知发送出错'
+    else:
+        level, summary = 'info', f'{notification_type} 通知状态: {status}'
+    return Event(event_type='notification', product_id=product_id, product_name=product_name,
+                 level=level, message=summary, details=f'消息: {message}' if message else '', timestamp=timestamp)
 
 class User(db.Model):
     """用户模型"""
@@ -206,6 +532,162 @@ class User(db.Model):
         """验证密码"""
         return self.password_hash == hashlib.sha256(password.encode('utf-8')).hexdigest()
 
+# 数据库结构迁移：db.create_all() 只会创建缺失的表，已存在的表由这里按版本号升级。
+# 当前版本记录在 SQLite 的 PRAGMA user_version 中，每个迁移只执行一次；
+# 新建的数据库同样会依次执行，因此迁移必须可以重复执行（字段与索引存在时跳过）。
+def add_column_if_missing(conn, table, column, ddl):
+    """表中缺少该字段时添加"""
+    existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({table})')}
+    if existing and column not in existing:
+        conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+        logger.info(f"数据库字段已补充: {table}.{column}")
+
+def migrate_add_monitor_columns(conn):
+    """并发、条件请求与自适应间隔相关字段"""
+    for table, column, ddl in [
+        ('notification_configs', 'fetch_concurrency', f'INTEGER DEFAULT {DEFAULT_FETCH_CONCURRENCY}'),
+        ('notification_configs', 'per_host_concurrency', f'INTEGER DEFAULT {DEFAULT_PER_HOST_CONCURRENCY}'),
+        ('notification_configs', 'per_host_interval', f'FLOAT DEFAULT {DEFAULT_PER_HOST_INTERVAL}'),
+        ('products', 'etag', 'VARCHAR(200)'),
+        ('products', 'last_modified', 'VARCHAR(100)'),
+        ('products', 'content_hash', 'VARCHAR(64)'),
+        ('products', 'needs_full_document', 'BOOLEAN DEFAULT 0'),
+        ('products', 'min_interval', 'INTEGER'),
+        ('products', 'max_interval', 'INTEGER'),
+    ]:
+        add_column_if_missing(conn, table, column, ddl)
+
+def migrate_add_history_indexes(conn):
+    """库存历史与通知日志按商品、按时间查询的索引"""
+    for name, table, columns in [
+        ('ix_stock_histories_product_timestamp', 'stock_histories', 'product_id, timestamp'),
+        ('ix_stock_histories_timestamp', 'stock_histories', 'timestamp'),
+        ('ix_notification_logs_product_timestamp', 'notification_logs', 'product_id, timestamp'),
+        ('ix_notification_logs_timestamp', 'notification_logs', 'timestamp'),
+    ]:
+        conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+    conn.exec_driver_sql('ANALYZE')
+
+def migrate_backfill_stock_rollups(conn):
+    """根据已有的库存历史生成汇总数据（每个粒度一条 INSERT ... SELECT ... GROUP BY，在数据库内完成）"""
+    StockRollup.__table__.create(conn, checkfirst=True)
+    conn.execute(StockRollup.__table__.delete())
+    
+    for resolution, bucket_format in ROLLUP_BUCKET_FORMATS.items():
+        # 开盘库存取时间段内第一次变化前的库存，收盘库存取最后一次变化后的库存（按时间、ID 排序）
+        inserted = conn.exec_driver_sql(f"""
+            INSERT INTO {StockRollup.__tablename__} (product_id, resolution, bucket_start, open_stock, close_stock,
+                                                     min_stock, max_stock, restock_units, sold_units, change_count)
+            SELECT product_id, ?, bucket_start,
+                   MAX(CASE WHEN first_rank = 1 THEN old_stock END), MAX(CASE WHEN last_rank = 1 THEN new_stock END),
+                   MIN(MIN(old_stock, new_stock)), MAX(MAX(old_stock, new_stock)),
+                   SUM(MAX(new_stock - old_stock, 0)), SUM(MAX(old_stock - new_stock, 0)), COUNT(*)
+            FROM (
+                SELECT product_id, strftime(?, timestamp) AS bucket_start,
+                       IFNULL(previous_stock, 0) AS old_stock, stock_count AS new_stock,
+                       ROW_NUMBER() OVER (PARTITION BY product_id, strftime(?, timestamp) ORDER BY timestamp, id) AS first_rank,
+                       ROW_NUMBER() OVER (PARTITION BY product_id, strftime(?, timestamp) ORDER BY timestamp DESC, id DESC) AS last_rank
+                FROM {StockHistory.__tablename__}
+                WHERE timestamp IS NOT NULL
+            )
+            WHERE true
+            GROUP BY product_id, bucket_start
+            ON CONFLICT (product_id, resolution, bucket_start) DO UPDATE SET
+                close_stock = excluded.close_stock,
+                min_stock = MIN(min_stock, excluded.min_stock),
+                max_stock = MAX(max_stock, excluded.max_stock),
+                restock_units = restock_units + excluded.restock_units,
+                sold_units = sold_units + excluded.sold_units,
+                change_count = change_count + excluded.change_count
+        """, (resolution, bucket_format, bucket_format, bucket_format)).rowcount
+        logger.info(f"库存汇总（{resolution}）已生成 {inserted} 个时间段")
+
+def migrate_add_retention(conn):
+    """日志保留天数字段，并把数据库切换为增量回收模式"""
+    add_column_if_missing(conn, 'notification_configs', 'history_retention_days', f'INTEGER DEFAULT {DEFAULT_HISTORY_RETENTION_DAYS}')
+    add_column_if_missing(conn, 'notification_configs', 'notification_retention_days', f'INTEGER DEFAULT {DEFAULT_NOTIFICATION_RETENTION_DAYS}')
+    if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+        # 修改回收模式需要整理一次数据库才能生效（VACUUM 不能在事务中执行）
+        conn.commit()
+        conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.exec_driver_sql('VACUUM')
+        logger.info("数据库已切换为增量回收模式")
+
+def migrate_backfill_events(conn):
+    """根据已有的库存历史与通知日志生成事件记录（按时间顺序写入，序号与时间一致）
+    
+    在数据库内用一条 INSERT ... SELECT 完成，文本与 stock_change_event / notification_event 生成的一致，
+    历史数据很多时也不需要读入内存。
+    """
+    Event.__table__.create(conn, checkfirst=True)
+    if conn.execute(db.select(db.func.count()).select_from(Event.__table__)).scalar():
+        return
+    
+    inserted = conn.exec_driver_sql(f"""
+        INSERT INTO {Event.__tablename__} (event_type, product_id, product_name, level, message, details, timestamp)
+        SELECT event_type, product_id, product_name, level, message, details, timestamp FROM (
+            SELECT 'stock_change' AS event_type, h.product_id AS product_id, p.name AS product_name,
+                   CASE WHEN h.stock_count > IFNULL(h.previous_stock, 0) THEN 'success'
+                        WHEN h.stock_count < IFNULL(h.previous_stock, 0) THEN 'warning' ELSE 'info' END AS level,
+                   CASE WHEN h.stock_count > IFNULL(h.previous_stock, 0)
+                            THEN '库存补货: +' || (h.stock_count - IFNULL(h.previous_stock, 0)) || ' 件'
+                        WHEN h.stock_count < IFNULL(h.previous_stock, 0)
+                            THEN '库存减少: -' || (IFNULL(h.previous_stock, 0) - h.stock_count) || ' 件'
+                        ELSE '库存变化: +0 件' END AS message,
+                   '库存变化: ' || IFNULL(h.previous_stock, 0) || ' → ' || h.stock_count AS details,
+                   h.timestamp AS timestamp, 0 AS source, h.id AS source_id
+            FROM {StockHistory.__tablename__} h LEFT JOIN {Product.__tablename__} p ON p.id = h.product_id
+            UNION ALL
+            SELECT 'notification', n.product_id, p.name,
+                   CASE WHEN n.status = 'sent' THEN 'success' WHEN n.status IN ('failed', 'error') THEN 'error' ELSE 'info' END,
+                   n.notification_type || CASE WHEN n.status = 'sent' THEN ' 通知发送成功'
+                                               WHEN n.status = 'failed' THEN ' 通知发送失败'
+                                               WHEN n.status = 'error' THEN ' 通知发送出错'
+                                               ELSE ' 通知状态: ' || IFNULL(n.status, 'None') END,
+                   CASE WHEN n.message IS NULL OR n.message = '' THEN '' ELSE '消息: ' || n.message END,
+                   n.timestamp, 1, n.id
+            FROM {NotificationLog.__tablename__} n LEFT JOIN {Product.__tablename__} p ON p.id = n.product_id
+        )
+        ORDER BY timestamp, source, source_id
+    """).rowcount
+    logger.info(f"事件日志已根据 {inserted} 条历史记录生成")
+
+def migrate_add_digest(conn):
+    """汇总通知配置与发件箱的汇总字段"""
+    add_column_if_missing(conn, 'notification_configs', 'digest_enabled', 'BOOLEAN DEFAULT 0')
+    add_column_if_missing(conn, 'notification_configs', 'digest_window', f'INTEGER DEFAULT {DEFAULT_DIGEST_WINDOW}')
+    add_column_if_missing(conn, 'notification_outbox', 'digest', 'BOOLEAN NOT NULL DEFAULT 0')
+    add_column_if_missing(conn, 'notification_outbox', 'summary', 'VARCHAR(500)')
+
+# (版本号, 说明, 迁移函数)，只能在末尾追加
+SCHEMA_MIGRATIONS = [
+    (1, '监控相关字段', migrate_add_monitor_columns),
+    (2, '历史与日志索引', migrate_add_history_indexes),
+    (3, '库存历史汇总', migrate_backfill_stock_rollups),
+    (4, '日志保留策略', migrate_add_retention),
+    (5, '事件日志', migrate_backfill_events),
+    (6, '汇总通知', migrate_add_digest),
+]
+
+def run_schema_migrations():
+    """执行尚未应用的数据库迁移，每个迁移在独立事务中完成并更新版本号"""
+    try:
+        with app.app_context():
+            with db.engine.connect() as conn:
+                current = conn.exec_driver_sql('PRAGMA user_version').scalar() or 0
+            
+            for version, description, migrate in SCHEMA_MIGRATIONS:
+                if version <= current:
+                    continue
+                with db.engine.connect() as conn:
+                    migrate(conn)
+                    conn.exec_driver_sql(f'PRAGMA user_version = {version}')
+                    conn.commit()
+                current = version
+                logger.info(f"数据库迁移完成: v{version} {description}")
+    except Exception as e:
+        logger.error(f"数据库结构升级失败: {e}")
+
 # 登录相关配置
 DEFAULT_ADMIN_USERNAME = 'admin'
 DEFAULT_ADMIN_PASSWORD = 'admin123'
@@ -259,71 +741,338 @@ def init_default_user():
     except Exception as e:
         logger.error(f"初始化默认用户失败: {e}")
 
+# 库存检测结果
+StockCheckResult = namedtuple('StockCheckResult', ['stock', 'not_modified', 'validators'])
+
+class CheckCancelled(Exception):
+    """本轮监控已超过截止时间，尚未完成的检测主动放弃"""
+    pass
+
+def iter_until_cancelled(chunks, cancel_event):
+    """逐块读取数据，轮次取消后停止读取"""
+    for chunk in chunks:
+        if cancel_event.is_set():
+            raise CheckCancelled()
+        yield chunk
+
+def get_url_host(url):
+    """获取URL所属站点（域名:端口）"""
+    return urlparse(url).netloc.lower()
+
+class _HostState:
+    """单个站点的调度状态"""
+    def __init__(self, session, max_concurrency):
+        self.session = session
+        self.semaphore = BoundedSemaphore(max_concurrency)
+        self.lock = Lock()
+        self.next_allowed = 0.0
+        self.request_count = 0
+
+class HostDispatcher:
+    """按站点调度请求：限制单站点并发、保证同站点请求间隔，并为每个站点维护独立的长连接池"""
+    def __init__(self, headers, max_concurrency=DEFAULT_PER_HOST_CONCURRENCY, min_interval=DEFAULT_PER_HOST_INTERVAL):
+        self.headers = headers
+        self.max_concurrency = max_concurrency
+        self.min_interval = min_interval
+        self._hosts = {}
+        self._lock = Lock()
+
+    def configure(self, max_concurrency, min_interval):
+        """更新调度参数，并发上限变化时重建各站点连接池并关闭旧连接池"""
+        old_states = []
+        with self._lock:
+            if max_concurrency != self.max_concurrency:
+                self.max_concurrency = max_concurrency
+                # 进行中的请求仍持有旧状态，新请求使用新的连接池与并发上限
+                old_states = list(self._hosts.values())
+                self._hosts = {}
+            self.min_interval = min_interval
+        # 关闭旧 Session：空闲连接立即释放，进行中的请求完成后其连接归还时随之关闭
+        for state in old_states:
+            state.session.close()
+
+    def _get_state(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                # 连接池大小与单站点并发上限一致，保证长连接可复用
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                state = _HostState(session, self.max_concurrency)
+                self._hosts[host] = state
+            return state
+
+    @contextmanager
+    def slot(self, url, cancel_event=None):
+        """获取站点访问槽位，返回该站点专用的 Session；等待期间轮次被取消时抛出 CheckCancelled"""
+        state = self._get_state(get_url_host(url))
+        with state.semaphore:
+            # 预约请求时间点后在锁外等待，避免阻塞同站点的其他请求排队
+            with state.lock:
+                now = time.monotonic()
+                start_at = max(now, state.next_allowed)
+                state.next_allowed = start_at + self.min_interval
+                state.request_count += 1
+            wait = start_at - now
+            if cancel_event is not None:
+                if cancel_event.wait(max(wait, 0)):
+                    raise CheckCancelled()
+            elif wait > 0:
+                time.sleep(wait)
+            yield state.session
+
+    def stats(self):
+        """各站点请求统计"""
+        with self._lock:
+            return {host: state.request_count for host, state in self._hosts.items()}
+
+# 库存数字提取正则
+STOCK_NUMBER_RE = re.compile(r'\d+')
+
+# 依赖后续内容才能判断是否匹配的伪类，含有这些伪类的选择器不能提前结束解析
+LOOKAHEAD_PSEUDO_RE = re.compile(r':(last-child|last-of-type|only-child|only-of-type|nth-last-child|nth-last-of-type|empty|has)\b')
+
+# 流式解析每次读取的数据块大小
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def get_response_charset(response):
+    """获取响应头中声明的字符集，未声明时交给解析器根据页面 meta 判断"""
+    if 'charset' in response.headers.get('Content-Type', '').lower():
+        return response.encoding
+    return None
+
+def get_element_text(element):
+    """提取 lxml 元素文本，效果等同 BeautifulSoup 的 get_text(strip=True)"""
+    return ''.join(text.strip() for text in element.itertext())
+
+class CompiledSelector:
+    """编译后的CSS选择器：优先转换为 XPath 在 lxml 文档树上执行，无法转换时回退到 BeautifulSoup"""
+    _thread_local = threading.local()
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.expression = None
+        if HTMLTranslator is not None:
+            try:
+                self.expression = HTMLTranslator().css_to_xpath(selector)
+            except SelectorError as e:
+                logger.info(f"选择器无法由 lxml 处理，使用 BeautifulSoup 解析: {selector} ({e})")
+
+    @property
+    def uses_lxml(self):
+        return self.expression is not None
+
+    @property
+    def streamable(self):
+        """是否可以边下载边解析：匹配结果只依赖元素之前的内容"""
+        return self.uses_lxml and not LOOKAHEAD_PSEUDO_RE.search(self.selector)
+
+    def _xpath(self):
+        # lxml 的 XPath 对象不跨线程共享，每个线程各自编译一次
+        cache = getattr(self._thread_local, 'xpaths', None)
+        if cache is None:
+            cache = self._thread_local.xpaths = {}
+        xpath = cache.get(self.expression)
+        if xpath is None:
+            xpath = cache[self.expression] = etree.XPath(self.expression)
+        return xpath
+
+    def select_element(self, root):
+        """在已解析的 lxml 文档树中查找第一个匹配元素"""
+        matches = self._xpath()(root)
+        return matches[0] if matches else None
+
+    def extract_text(self, content, encoding=None):
+        """从页面内容中提取第一个匹配元素的文本，未找到时返回 None"""
+        if self.uses_lxml:
+            try:
+                parser = lxml.html.HTMLParser(encoding=encoding)
+                root = lxml.html.document_fromstring(content, parser=parser)
+            except (etree.ParserError, ValueError) as e:
+                logger.warning(f"页面解析失败: {e}")
+                return None
+            element = self.select_element(root)
+            return get_element_text(element) if element is not None else None
+        
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(content, 'html.parser', from_encoding=encoding)
+        element = soup.select_one(self.selector)
+        return element.get_text(strip=True) if element else None
+
+    def extract_text_streaming(self, chunks, encoding=None):
+        """增量解析数据块，第一个匹配元素解析完成后立即停止读取
+        
+        返回 (元素文本, 已读取内容的哈希)，未找到元素时文本为 None
+        """
+        parser = etree.HTMLPullParser(events=('end',), encoding=encoding)
+        digest = hashlib.sha1()
+        root = None
+        pending = None
+        
+        for chunk in chunks:
+            digest.update(chunk)
+            parser.feed(chunk)
+            ended = [element for _, element in parser.read_events()]
+            if not ended:
+                continue
+            if root is None:
+                root = ended[0].getroottree().getroot()
+            if pending is None:
+                # 第一个匹配元素出现后不会再改变（后续内容在文档顺序上都在其之后）
+                pending = self.select_element(root)
+            if pending is not None and any(element is pending for element in ended):
+                return get_element_text(pending), digest.hexdigest()
+        
+        # 读取完毕仍未提前结束：解析剩余内容后再查找一次
+        try:
+            root = parser.close()
+        except etree.XMLSyntaxError as e:
+            logger.warning(f"页面解析失败: {e}")
+            return None, digest.hexdigest()
+        element = self.select_element(root) if root is not None else None
+        return (get_element_text(element) if element is not None else None), digest.hexdigest()
+
+class SelectorEngine:
+    """商品选择器缓存：每个商品的选择器只编译一次，商品编辑后失效"""
+    def __init__(self):
+        self._cache = {}
+        self._lock = Lock()
+
+    def get(self, product_id, selector):
+        """获取商品的已编译选择器（临时商品不缓存）"""
+        if not product_id:
+            return CompiledSelector(selector)
+        with self._lock:
+            compiled = self._cache.get(product_id)
+        if compiled is None or compiled.selector != selector:
+            compiled = CompiledSelector(selector)
+            with self._lock:
+                self._cache[product_id] = compiled
+        return compiled
+
+    def invalidate(self, product_id):
+        """商品编辑或删除后清除缓存"""
+        with self._lock:
+            self._cache.pop(product_id, None)
+
 # 库存监控类 - 重构版
 class InventoryMonitorV2:
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
+        self.hosts = HostDispatcher({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
+        self.selectors = SelectorEngine()
 
-    def check_stock(self, product):
-        """检查单个商品库存 - 改进版"""
+    def fetch_stock(self, product, conditional=True, cancel_event=None):
+        """检查单个商品库存（条件请求），页面未变化时跳过解析
+        
+        未标记需要完整页面的商品按流式解析，找到库存元素后立即断开连接。
+        cancel_event 被设置时（轮次超时）放弃检测并抛出 CheckCancelled。
+        返回 StockCheckResult: stock 为解析出的库存（失败或未变化时为 None），
+        not_modified 表示页面未变化，validators 为需要保存的缓存校验信息
+        """
         try:
             logger.info(f"开始检查商品库存: {product.name}")
             
-            response = self.session.get(product.url, timeout=15)
-            response.raise_for_status()
+            headers = {}
+            if conditional:
+                if getattr(product, 'etag', None):
+                    headers['If-None-Match'] = product.etag
+                if getattr(product, 'last_modified', None):
+                    headers['If-Modified-Since'] = product.last_modified
             
-            from bs4 import BeautifulSoup
-            soup = BeautifulSoup(response.text, 'html.parser')
+            selector = self.selectors.get(getattr(product, 'id', None), product.target_selector)
+            streaming = selector.streamable and not getattr(product, 'needs_full_document', False)
+            stock_text = None
             
-            # 根据CSS选择器获取库存数量
-            stock_element = soup.select_one(product.target_selector)
+            with self.hosts.slot(product.url, cancel_event) as session:
+                response = session.get(product.url, timeout=15, headers=headers, stream=streaming)
+                try:
+                    if response.status_code == 304:
+                        logger.info(f"页面未修改(304)，跳过解析: {product.name}")
+                        return StockCheckResult(None, True, None)
+                    
+                    response.raise_for_status()
+                    
+                    if streaming:
+                        # 流式模式下哈希只覆盖读取到库存元素为止的内容
+                        chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                        if cancel_event is not None:
+                            chunks = iter_until_cancelled(chunks, cancel_event)
+                        stock_text, content_hash = selector.extract_text_streaming(chunks, get_response_charset(response))
+                    else:
+                        content_hash = hashlib.sha1(response.content).hexdigest()
+                finally:
+                    # 提前结束时关闭连接，不再下载剩余内容
+                    response.close()
             
-            if stock_element:
-                import re
-                stock_text = stock_element.get_text(strip=True)
-                logger.info(f"提取到库存文本: '{stock_text}'")
-                
-                # 提取数字
-                numbers = re.findall(r'\d+', stock_text)
-                current_stock = int(numbers[0]) if numbers else 0
-                
-                logger.info(f"解析库存数量: {current_stock}")
-                return current_stock
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'content_hash': content_hash
+            }
+            
+            if conditional and validators['content_hash'] == getattr(product, 'content_hash', None):
+                logger.info(f"页面内容未变化，跳过{'写库' if streaming else '解析'}: {product.name}")
+                # 校验头变化时仍需保存，以便下次命中 304
+                if validators['etag'] == product.etag and validators['last_modified'] == product.last_modified:
+                    validators = None
+                return StockCheckResult(None, True, validators)
+            
+            if streaming:
+                current_stock = self._parse_stock_text(stock_text)
             else:
+                current_stock, _ = self._extract_stock(response, product)
+            if current_stock is None:
                 logger.warning(f"未找到库存元素: {product.target_selector}")
-                return 0
+                current_stock = 0
+            return StockCheckResult(current_stock, False, validators)
                 
+        except CheckCancelled:
+            raise
         except Exception as e:
             logger.error(f"检查商品 {product.name} 库存失败: {str(e)}")
+            return StockCheckResult(None, False, None)
+
+    def check_stock(self, product):
+        """检查单个商品库存 - 改进版（总是完整下载并解析页面）"""
+        return self.fetch_stock(product, conditional=False).stock
+
+    def _extract_stock(self, response, product):
+        """按商品选择器提取库存，返回 (库存数量, 提取文本)，未找到元素时返回 (None, None)"""
+        selector = self.selectors.get(getattr(product, 'id', None), product.target_selector)
+        stock_text = selector.extract_text(response.content, get_response_charset(response))
+        return self._parse_stock_text(stock_text), stock_text
+
+    def _parse_stock_text(self, stock_text):
+        """从库存文本中提取库存数量，文本为 None（未找到元素）时返回 None"""
+        if stock_text is None:
             return None
+        
+        logger.info(f"提取到库存文本: '{stock_text}'")
+        
+        # 提取数字
+        match = STOCK_NUMBER_RE.search(stock_text)
+        current_stock = int(match.group()) if match else 0
+        
+        logger.info(f"解析库存数量: {current_stock}")
+        return current_stock
 
     def test_selector(self, product):
         """测试CSS选择器 - 返回详细信息用于API"""
         try:
             logger.info(f"开始检查商品库存: {product.name}")
             
-            response = self.session.get(product.url, timeout=15)
+            with self.hosts.slot(product.url) as session:
+                response = session.get(product.url, timeout=15)
             response.raise_for_status()
             
-            from bs4 import BeautifulSoup
-            soup = BeautifulSoup(response.text, 'html.parser')
+            current_stock, stock_text = self._extract_stock(response, product)
             
-            # 根据CSS选择器获取库存数量
-            stock_element = soup.select_one(product.target_selector)
-            
-            if stock_element:
-                import re
-                stock_text = stock_element.get_text(strip=True)
-                logger.info(f"提取到库存文本: '{stock_text}'")
-                
-                # 提取数字
-                numbers = re.findall(r'\d+', stock_text)
-                current_stock = int(numbers[0]) if numbers else 0
-                
-                logger.info(f"解析库存数量: {current_stock}")
+            if current_stock is not None:
                 return {
                     'success': True,
                     'stock_count': current_stock,
@@ -345,61 +1094,420 @@ class InventoryMonitorV2:
                 'details': '请检查URL是否正确且网站可以访问'
             }
 
-    def update_stock_safe(self, product_id, new_stock):
-        """安全更新商品库存 - 使用数据库锁"""
-        with db_lock:
-            try:
-                with app.app_context():
-                    # 重新获取最新的产品数据
-                    product = Product.query.filter_by(id=product_id).first()
-                    if not product:
-                        logger.error(f"产品ID {product_id} 不存在")
-                        return False, None, None
-                    
-                    old_stock = product.current_stock
-                    
-                    logger.info(f"库存更新: {product.name} - 旧库存: {old_stock}, 新库存: {new_stock}")
-                    
-                    # 更新库存信息
-                    product.last_stock = old_stock
-                    product.current_stock = new_stock
-                    product.updated_at = get_internet_time().replace(tzinfo=None)
-                    product.version += 1  # 版本控制
-                    
-                    # 确定变化类型并只在有变化时记录历史
-                    stock_changed = (old_stock != new_stock)
-                    if stock_changed:
-                        if new_stock > old_stock:
-                            change_type = "increase"
-                        elif new_stock < old_stock:
-                            change_type = "decrease"
-                        
-                        # 只在库存变化时记录历史
-                        history = StockHistory(
-                            product_id=product.id,
-                            stock_count=new_stock,
-                            previous_stock=old_stock,
-                            change_type=change_type
-                        )
-                        db.session.add(history)
-                        logger.info(f"库存历史记录: {product.name} {change_type} - {old_stock} → {new_stock}")
-                    else:
-                        logger.debug(f"库存无变化，跳过历史记录: {product.name} - {new_stock}")
-                    
-                    # 提交事务
-                    db.session.commit()
-                    
-                    logger.info(f"库存更新成功: {product.name}, 是否变化: {stock_changed}")
-                    
-                    return stock_changed, old_stock, new_stock
-                    
-            except Exception as e:
-                logger.error(f"库存更新失败: 产品ID {product_id}, 错误: {e}")
+    def update_stock_safe(self, product_id, new_stock, validators=None, version=None):
+        """立即更新单个商品库存（不发送通知），返回 (是否变化, 旧库存, 新库存)
+        
+        validators 为本次检测得到的缓存校验信息；未提供时清空旧的校验信息，
+        保证保存的内容哈希始终对应当前库存。version 为检测开始时的商品版本号，
+        商品期间被修改时不写入并返回 (False, None, None)
+        """
+        buffer = StockWriteBuffer()
+        buffer.add_stock(product_id, new_stock, validators, version)
+        for change in buffer.flush(notify=False):
+            return True, change.old_stock, change.new_stock
+        if buffer.results['unchanged']:
+            return False, new_stock, new_stock
+        return False, None, None
+
+# 库存变化记录
+StockChange = namedtuple('StockChange', ['product_id', 'old_stock', 'new_stock'])
+
+# 写入库存变化时的商品快照（生成通知消息用）
+ProductSnapshot = namedtuple('ProductSnapshot', ['id', 'name', 'url', 'buy_url', 'current_stock', 'last_stock'])
+
+# 写缓冲默认批量大小：每积累这么多条检测结果提交一次
+WRITE_BATCH_SIZE = 20
+
+class StaleVersion(Exception):
+    """商品在读取后被其他写入者修改（版本号不一致）"""
+    pass
+
+# 版本冲突或数据库忙时整批重试的次数，重试前随机退避避免再次冲突
+WRITE_MAX_RETRIES = 5
+WRITE_RETRY_BACKOFF = 0.02
+
+class StockWriteBuffer:
+    """库存写缓冲：收集一轮中各商品的检测结果，按批在一个事务中写入
+    
+    - 库存变化：按版本号比较并更新库存、记录历史，通知在同一事务中写入发件箱，提交后再触发发送
+    - 库存未变化：批量刷新 updated_at，仅在校验信息变化时单独更新
+    - 页面未变化：只在响应头中的校验信息变化时写入
+    
+    旧库存在提交时从数据库读取，写入时校验版本号未变；期间被其他写入者修改则整批重新读取重试，
+    变化判断与通知使用同一事务内的新旧值。检测开始后商品被编辑（版本号变化）的结果直接丢弃，
+    避免按旧网址、旧选择器取得的库存写入修改后的商品。
+    """
+    def __init__(self, config=None, batch_size=WRITE_BATCH_SIZE):
+        self.config = config
+        self.batch_size = max(1, batch_size)
+        self.results = {'changed': 0, 'unchanged': 0}
+        # product_id -> (new_stock, validators, expected_version)；new_stock 为 None 表示只更新校验信息
+        self._pending = {}
+        self._lock = Lock()
+
+    def add_stock(self, product_id, new_stock, validators=None, version=None):
+        """加入一条库存检测结果，达到批量大小时立即提交；version 为检测开始时读取的商品版本号"""
+        self._add(product_id, (new_stock, validators or {}, version))
+
+    def add_validators(self, product_id, validators, version):
+        """加入页面未变化时新的缓存校验信息，version 为检测时读取的商品版本号"""
+        self._add(product_id, (None, validators, version))
+
+    def _add(self, product_id, entry):
+        with self._lock:
+            self._pending[product_id] = entry
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self, notify=True):
+        """提交缓冲中的全部结果，返回本批库存变化列表"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return []
+        
+        changes, changed_products = [], {}
+        with app.app_context():
+            for attempt in range(1, WRITE_MAX_RETRIES + 1):
                 try:
+                    changes, touched, written_at, staged = self._write(pending, notify)
+                    db.session.commit()
+                except (StaleVersion, OperationalError) as e:
                     db.session.rollback()
-                except:
-                    pass
-                return False, None, None
+                    logger.warning(f"批量写入冲突，第 {attempt} 次重试: {e}")
+                    changes, staged = [], []
+                    time.sleep(random.uniform(0, WRITE_RETRY_BACKOFF * 2 ** attempt))
+                    continue
+                except Exception as e:
+                    logger.error(f"批量写入库存失败: 商品 {list(pending)}, 错误: {e}")
+                    try:
+                        db.session.rollback()
+                    except:
+                        pass
+                    return []
+                
+                # 提交后重新读取变化的商品，脱离会话供计算检测间隔使用
+                if changes:
+                    for product in Product.query.filter(Product.id.in_([c.product_id for c in changes])).all():
+                        db.session.expunge(product)
+                        changed_products[product.id] = product
+                
+                for change in changes:
+                    dashboard_stats.set_stock(change.product_id, change.new_stock)
+                if changes or touched:
+                    dashboard_stats.touch(written_at)
+                if changes:
+                    data_versions.bump('events')
+                    event_broker.notify()
+                
+                self.results['changed'] += len(changes)
+                self.results['unchanged'] += len(touched)
+                logger.info(f"批量写入完成: 商品 {len(pending)} 个, 库存变化 {len(changes)} 个")
+                break
+            else:
+                logger.error(f"批量写入库存失败: 商品 {list(pending)}, 多次重试仍然冲突")
+                return []
+        
+        for change in changes:
+            product = changed_products.get(change.product_id)
+            if product is None:
+                continue
+            min_interval, _ = adaptive_scheduler.get_bounds(product, get_default_interval(self.config))
+            adaptive_scheduler.record_change(product.id, min_interval)
+        
+        # 通知已随库存变化提交到发件箱，这里只触发发送；发送线程繁忙或进程重启时由重试任务发送
+        for targets, digest_window in staged:
+            if digest_window:
+                outbox.schedule_flush(digest_window)
+                continue
+            for chat_id, row_id in targets:
+                notification_dispatcher.submit(chat_id, row_id, self.config.telegram_bot_token)
+        
+        return changes
+
+    def _write(self, pending, notify=True):
+        """在当前事务中写入一批结果（不提交），返回 (库存变化列表, 库存未变化的商品ID, 写入时间, 已写入发件箱的通知)"""
+        now = get_internet_time().replace(tzinfo=None)
+        rows = db.session.query(Product.id, Product.name, Product.url, Product.buy_url, Product.current_stock,
+                                Product.version, Product.etag, Product.last_modified, Product.content_hash)\
+            .filter(Product.id.in_(list(pending))).all()
+        changes, touched, staged = [], [], []
+        
+        for row in rows:
+            new_stock, validators, expected_version = pending[row.id]
+            values = {key: validators.get(key) for key in ('etag', 'last_modified', 'content_hash')
+                      if key in validators or new_stock is not None}
+            values = {key: value for key, value in values.items() if getattr(row, key) != value}
+            
+            if new_stock is None:
+                # 页面未变化：检测后商品被修改过则丢弃这些校验信息
+                if values and expected_version == row.version:
+                    Product.query.filter(Product.id == row.id, Product.version == row.version)\
+                        .update(values, synchronize_session=False)
+                continue
+            
+            if expected_version is not None and expected_version != row.version:
+                logger.info(f"检测期间商品已被修改，丢弃本次结果: {row.name}")
+                continue
+            
+            old_stock = row.current_stock
+            if old_stock == new_stock:
+                logger.debug(f"库存无变化，跳过历史记录: {row.name} - {new_stock}")
+                if values:
+                    # 保存的内容哈希始终对应当前库存
+                    if not self._compare_and_swap(row, values):
+                        raise StaleVersion(f"商品 {row.name} 版本已变化")
+                touched.append(row.id)
+                continue
+            
+            change_type = "increase" if new_stock > old_stock else "decrease"
+            logger.info(f"库存更新: {row.name} - 旧库存: {old_stock}, 新库存: {new_stock}")
+            values.update({
+                'last_stock': old_stock,
+                'current_stock': new_stock,
+                'updated_at': now,
+                'version': Product.version + 1  # 版本控制
+            })
+            if not self._compare_and_swap(row, values):
+                raise StaleVersion(f"商品 {row.name} 版本已变化")
+            
+            db.session.add(StockHistory(
+                product_id=row.id,
+                stock_count=new_stock,
+                previous_stock=old_stock,
+                change_type=change_type,
+                timestamp=now
+            ))
+            record_stock_rollups(row.id, old_stock, new_stock, now)
+            db.session.add(stock_change_event(row.id, row.name, old_stock, new_stock, now))
+            change = StockChange(row.id, old_stock, new_stock)
+            changes.append(change)
+            logger.info(f"库存历史记录: {row.name} {change_type} - {old_stock} → {new_stock}")
+            
+            if notify:
+                product = ProductSnapshot(row.id, row.name, row.url, row.buy_url, new_stock, old_stock)
+                notification = self._stage_notification(product, change)
+                if notification:
+                    staged.append(notification)
+        
+        if touched:
+            Product.query.filter(Product.id.in_(touched))\
+                .update({Product.updated_at: now}, synchronize_session=False)
+        
+        return changes, touched, now, staged
+
+    @staticmethod
+    def _compare_and_swap(row, values):
+        """仅当版本号仍为读取时的值时更新商品"""
+        return Product.query.filter(Product.id == row.id, Product.version == row.version)\
+            .update(values, synchronize_session=False) == 1
+
+    def _stage_notification(self, product, change):
+        """在写入库存变化的事务中写入通知，返回 ([(聊天ID, 发件箱记录ID)], 汇总窗口秒数)，不需要发送时返回 None"""
+        if not self.config:
+            logger.info("未配置通知，跳过")
+            return None
+        
+        # 判断是否需要发送通知
+        should_notify, notification_type, stock_difference = notifier.should_send_notification(change.old_stock, change.new_stock)
+        if not should_notify:
+            logger.info(f"不需要发送通知: {product.name}")
+            return None
+        
+        rows = notifier.stage_notification(self.config, product, notification_type, stock_difference)
+        if not rows:
+            return None
+        db.session.flush()
+        logger.info(f"通知写入发件箱: {product.name} {notification_type}")
+        return [(row.chat_id, row.id) for row in rows], get_digest_window(self.config)
+
+# Telegram 接口调用结果：retry_after 为限流时需要等待的秒数，permanent 表示重试也不会成功，latency 为请求耗时（秒）
+SendResult = namedtuple('SendResult', 'ok retry_after permanent error latency', defaults=(None,))
+
+TELEGRAM_API_BASE = 'https://api.telegram.org'
+TELEGRAM_TIMEOUT = 10
+TELEGRAM_POOL_SIZE = 8             # 长连接池大小，同时也是并行发送的聊天数上限
+
+class TelegramClient:
+    """共享的 Telegram 接口客户端：长连接池复用 TCP/TLS 连接，多个聊天并行发送，记录各聊天的请求耗时"""
+    def __init__(self, pool_size=TELEGRAM_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='telegram')
+        self._latency = {}  # chat_id -> 耗时统计
+        self._lock = Lock()
+
+    def send_message(self, bot_token, chat_id, text, reply_markup=None, disable_web_page_preview=True):
+        """调用 sendMessage，返回 SendResult"""
+        data = {
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': 'Markdown',
+            'disable_web_page_preview': disable_web_page_preview
+        }
+        if reply_markup:
+            data['reply_markup'] = reply_markup
+        
+        started = time.monotonic()
+        try:
+            response = self.session.post(f"{TELEGRAM_API_BASE}/bot{bot_token}/sendMessage", data=data, timeout=TELEGRAM_TIMEOUT)
+        except requests.RequestException as e:
+            return self._record(chat_id, SendResult(False, None, False, str(e), time.monotonic() - started))
+        latency = time.monotonic() - started
+        
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+        if response.ok and result.get('ok'):
+            return self._record(chat_id, SendResult(True, None, False, None, latency))
+        
+        error = result.get('description') or f'HTTP {response.status_code}'
+        if response.status_code == 429:
+            retry_after = (result.get('parameters') or {}).get('retry_after') or response.headers.get('Retry-After') or 1
+            return self._record(chat_id, SendResult(False, float(retry_after), False, error, latency))
+        # 4xx（聊天不存在、机器人被移出等）重试也不会成功
+        return self._record(chat_id, SendResult(False, None, 400 <= response.status_code < 500, error, latency))
+
+    def send_many(self, bot_token, messages):
+        """并行发送多条消息 [(chat_id, text, reply_markup)]，返回顺序与输入一致的 SendResult 列表"""
+        return self.fan_out(lambda message: self.send_message(bot_token, *message), messages)
+
+    def fan_out(self, func, items):
+        """在发送线程池中并行执行，返回顺序与输入一致的结果（只有一项时直接在当前线程执行）"""
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        return list(self._executor.map(func, items))
+
+    def _record(self, chat_id, result):
+        with self._lock:
+            stats = self._latency.setdefault(str(chat_id), {'count': 0, 'errors': 0, 'total': 0.0, 'last': None})
+            stats['count'] += 1
+            stats['errors'] += 0 if result.ok else 1
+            stats['total'] += result.latency
+            stats['last'] = result.latency
+        return result
+
+    def stats(self):
+        """各聊天的请求次数、失败次数与耗时（毫秒）"""
+        with self._lock:
+            return {chat_id: {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'avg_latency_ms': round(stats['total'] / stats['count'] * 1000, 1),
+                'last_latency_ms': round(stats['last'] * 1000, 1)
+            } for chat_id, stats in self._latency.items()}
+
+def get_notification_chats(config):
+    """已启用的通知聊天ID（去重，保持频道、群组、个人的顺序）"""
+    chat_ids = []
+    if config.channel_enabled and config.channel_id:
+        chat_ids.append(config.channel_id)
+    if config.group_enabled and config.group_id:
+        chat_ids.append(config.group_id)
+    if config.personal_enabled and config.personal_chat_id:
+        chat_ids.append(config.personal_chat_id)
+    # 新的用户通知字段（兼容性）
+    if getattr(config, 'user_enabled', False) and getattr(config, 'user_id', None):
+        chat_ids.append(config.user_id)
+    return list(dict.fromkeys(str(chat_id).strip() for chat_id in chat_ids))
+
+def get_digest_window(config):
+    """汇总窗口秒数，未开启汇总通知时返回 0"""
+    if not config or not getattr(config, 'digest_enabled', False):
+        return 0
+    window = getattr(config, 'digest_window', None)
+    if window is None:
+        window = DEFAULT_DIGEST_WINDOW
+    return max(0, min(int(window), MAX_DIGEST_WINDOW))
+
+def escape_markdown(text):
+    """转义 Telegram Markdown 的特殊字符"""
+    return re.sub(r'([_*`\[])', r'\\\1', str(text))
+
+# 通知模板：保存设置时解析并校验，编译后的渲染函数按模板文本缓存，发送时直接渲染
+TEMPLATE_VARIABLES = {
+    'product_name': '商品名称',
+    'current_stock': '当前库存',
+    'previous_stock': '之前库存',
+    'stock_difference': '库存变化数量',
+    'check_time': '检测时间',
+    'product_url': '商品链接',
+    'buy_url': '购买链接',
+}
+TEMPLATE_MARKDOWN_FIELDS = ('product_name', 'product_url', 'buy_url')  # 渲染前转义 Markdown 特殊字符
+TEMPLATE_SAMPLES = {
+    'restock': {'product_name': '示例商品', 'current_stock': 5, 'previous_stock': 3, 'stock_difference': 2,
+                'check_time': '2024-01-01 12:00:00', 'product_url': 'https://example.com/item', 'buy_url': 'https://example.com/buy'},
+    'sale': {'product_name': '示例商品', 'current_stock': 3, 'previous_stock': 4, 'stock_difference': 1,
+             'check_time': '2024-01-01 12:00:00', 'product_url': 'https://example.com/item', 'buy_url': 'https://example.com/buy'},
+}
+
+class TemplateError(ValueError):
+    """通知模板格式不正确"""
+
+@lru_cache(maxsize=64)
+def compile_template(text):
+    """解析并校验通知模板，返回渲染函数 render(变量字典) -> 消息文本
+    
+    只允许 TEMPLATE_VARIABLES 中的变量（不支持属性、下标访问和嵌套格式），并用示例数据试渲染一次检查格式说明。
+    """
+    try:
+        parsed = list(string.Formatter().parse(text))
+    except ValueError as e:
+        raise TemplateError(f'模板格式错误: {e}（字面的花括号请写成 {{{{ 或 }}}}）')
+    
+    parts = []
+    for literal, field, format_spec, conversion in parsed:
+        if field is None:
+            parts.append((literal, None, None, None))
+            continue
+        if field not in TEMPLATE_VARIABLES:
+            raise TemplateError(f'未知变量: {{{field}}}，可用变量: ' + ', '.join(f'{{{name}}}' for name in TEMPLATE_VARIABLES))
+        if conversion not in (None, 's', 'r'):
+            raise TemplateError(f'变量 {{{field}}} 的转换符无效: !{conversion}')
+        if '{' in format_spec:
+            raise TemplateError(f'变量 {{{field}}} 不支持嵌套格式')
+        parts.append((literal, field, format_spec, conversion))
+    
+    def render(variables):
+        chunks = []
+        for literal, field, format_spec, conversion in parts:
+            chunks.append(literal)
+            if field is not None:
+                value = variables[field]
+                if conversion == 's':
+                    value = str(value)
+                elif conversion == 'r':
+                    value = repr(value)
+                chunks.append(format(value, format_spec))
+        return ''.join(chunks)
+    
+    for sample in TEMPLATE_SAMPLES.values():
+        try:
+            render(sample)
+        except (ValueError, TypeError) as e:
+            raise TemplateError(f'变量格式错误: {e}')
+    return render
+
+def get_notification_template(config, notification_type):
+    """配置中的通知模板文本，未设置时使用默认模板（未知类型按补货模板处理）"""
+    if notification_type not in DEFAULT_NOTIFICATION_TEMPLATES:
+        notification_type = 'restock'
+    text = getattr(config, f'template_{notification_type}', None) if config else None
+    return text or DEFAULT_NOTIFICATION_TEMPLATES[notification_type]
+
+def render_template_message(template, variables):
+    """用编译好的模板渲染消息，商品名称和链接中的 Markdown 特殊字符会被转义"""
+    variables = dict(variables)
+    for field in TEMPLATE_MARKDOWN_FIELDS:
+        if variables.get(field) is not None:
+            variables[field] = escape_markdown(variables[field])
+    return compile_template(template)(variables)
 
 # Telegram通知类 - 改进版
 class TelegramNotifierV2:
@@ -433,17 +1541,14 @@ class TelegramNotifierV2:
         logger.info("不触发通知: 未知情况")
         return False, None, stock_difference
 
-    def send_notification(self, config, product, notification_type, stock_difference):
-        """发送通知"""
+    def stage_notification(self, config, product, notification_type, stock_difference):
+        """在当前事务中写入通知日志与发件箱记录（不提交），返回发件箱记录列表，不需要发送时返回空列表
+        
+        与库存变化在同一事务中提交：库存变化写入后通知一定在发件箱中，发送线程繁忙或进程重启都不会丢失。
+        """
         if not config or not config.telegram_bot_token:
             logger.warning("未配置Telegram Bot Token")
-            return
-
-        # 强制刷新 product，确保 current_stock 是最新
-        with app.app_context():
-            latest_product = Product.query.filter_by(id=product.id).first()
-            if latest_product:
-                product = latest_product
+            return []
 
         # 检查通知类型开关（向后兼容）
         restock_enabled = getattr(config, 'restock_enabled', True)
@@ -451,105 +1556,71 @@ class TelegramNotifierV2:
 
         if notification_type == "restock" and not restock_enabled:
             logger.info("补货通知已禁用，跳过发送")
-            return
+            return []
         elif notification_type == "sale" and not sale_enabled:
             logger.info("销售通知已禁用，跳过发送")
-            return
+            return []
 
         try:
-            message = self.format_message(product, notification_type, stock_difference)
-
-            # 记录通知日志
-            self._log_notification(product, notification_type, message, "attempting")
-
-            # 发送到各个渠道
-            sent_count = 0
-
-            if config.channel_enabled and config.channel_id:
-                if self._send_to_chat(config.telegram_bot_token, config.channel_id, message, product):
-                    sent_count += 1
-
-            if config.group_enabled and config.group_id:
-                if self._send_to_chat(config.telegram_bot_token, config.group_id, message, product):
-                    sent_count += 1
+            message = self.format_message(product, notification_type, stock_difference, config)
+            chat_ids = get_notification_chats(config)
+            reply_markup = self._build_reply_markup(product)
+            summary = self._format_summary(product, notification_type, stock_difference)
+        except Exception as e:
+            logger.error(f"生成通知异常: {product.name}, 错误: {e}")
+            db.session.add_all(self._notification_rows(product.id, product.name, notification_type, str(e), "error"))
+            return []
 
-            if config.personal_enabled and config.personal_chat_id:
-                if self._send_to_chat(config.telegram_bot_token, config.personal_chat_id, message, product):
-                    sent_count += 1
+        if not chat_ids:
+            db.session.add_all(self._notification_rows(product.id, product.name, notification_type, message, "failed"))
+            logger.error(f"通知发送失败: {product.name}, 没有可用渠道")
+            return []
 
-            # 新的用户通知字段（兼容性）
-            if hasattr(config, 'user_enabled') and hasattr(config, 'user_id') and config.user_enabled and config.user_id:
-                if self._send_to_chat(config.telegram_bot_token, config.user_id, message, product):
-                    sent_count += 1
+        # 记录通知日志，发送结果由发件箱在各聊天都有结果后记录
+        db.session.add_all(self._notification_rows(product.id, product.name, notification_type, message, "attempting"))
+        return outbox.enqueue(product, notification_type, message, reply_markup, chat_ids,
+                              get_digest_window(config), summary)
 
-            if sent_count > 0:
-                self._log_notification(product, notification_type, message, "sent")
-                logger.info(f"通知发送成功: {product.name}, 发送到 {sent_count} 个渠道")
-            else:
-                self._log_notification(product, notification_type, message, "failed")
-                logger.error(f"通知发送失败: {product.name}, 没有可用渠道")
+    def _build_reply_markup(self, product):
+        """内联键盘按钮（购买链接），没有按钮时返回 None"""
+        if not product.buy_url:
+            return None
+        return json.dumps({
+            "inline_keyboard": [[{
+                "text": "🛒 前往购买",
+                "url": product.buy_url
+            }]]
+        })
 
-        except Exception as e:
-            logger.error(f"发送通知异常: {product.name}, 错误: {e}")
-            self._log_notification(product, notification_type, str(e), "error")
+    def _format_summary(self, product, notification_type, stock_difference):
+        """汇总消息中的一行"""
+        name = escape_markdown(product.name)
+        if notification_type == "restock":
+            return f"🎉 {name} 补货 +{stock_difference}，当前库存 {product.current_stock}"
+        if notification_type == "sale":
+            return f"🛒 {name} 被购买 {abs(stock_difference)}，剩余库存 {product.current_stock}"
+        return f"📊 {name} 库存变化 {stock_difference:+d}，当前库存 {product.current_stock}"
 
-    def _send_to_chat(self, bot_token, chat_id, message, product):
-        """发送消息到指定聊天，支持内联按钮"""
-        try:
-            url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-            data = {
-                'chat_id': chat_id,
-                'text': message,
-                'parse_mode': 'Markdown',
-                'disable_web_page_preview': True
-            }
-            
-            # 添加内联键盘按钮
-            inline_keyboard = []
-            
-            # 购买按钮
-            if product.buy_url:
-                buy_button = [{
-                    "text": "🛒 前往购买",
-                    "url": product.buy_url
-                }]
-                inline_keyboard.append(buy_button)
-            
-            # 如果有按钮，添加到请求数据
-            if inline_keyboard:
-                reply_markup = {
-                    "inline_keyboard": inline_keyboard
-                }
-                data['reply_markup'] = json.dumps(reply_markup)
-            
-            response = requests.post(url, data=data, timeout=10)
-            response.raise_for_status()
-            
-            result = response.json()
-            if result.get('ok'):
-                logger.info(f"消息发送成功到 {chat_id}")
-                return True
-            else:
-                logger.error(f"Telegram API错误: {result}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"发送消息到 {chat_id} 失败: {e}")
-            return False
+    def _notification_rows(self, product_id, product_name, notification_type, message, status):
+        """通知日志及对应的事件记录"""
+        now = get_internet_time().replace(tzinfo=None)
+        log = NotificationLog(
+            product_id=product_id,
+            notification_type=notification_type,
+            message=message,
+            status=status,
+            timestamp=now
+        )
+        return [log, notification_event(product_id, product_name, notification_type, status, message, now)]
 
-    def _log_notification(self, product, notification_type, message, status):
+    def _log_notification(self, product_id, product_name, notification_type, message, status):
         """记录通知日志"""
         try:
-            with db_lock:
-                with app.app_context():
-                    log = NotificationLog(
-                        product_id=product.id,
-                        notification_type=notification_type,
-                        message=message,
-                        status=status
-                    )
-                    db.session.add(log)
-                    db.session.commit()
+            with app.app_context():
+                db.session.add_all(self._notification_rows(product_id, product_name, notification_type, message, status))
+                db.session.commit()
+            data_versions.bump('events')
+            event_broker.notify()
         except Exception as e:
             logger.error(f"记录通知日志失败: {e}")
             try:
@@ -557,165 +1628,932 @@ class TelegramNotifierV2:
             except:
                 pass
 
-    def format_message(self, product, notification_type, stock_difference):
-        """使用模板格式化通知消息"""
-        current_time = get_internet_time().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # 获取通知配置和模板
-        config = NotificationConfig.query.first()
-        if not config:
-            # 使用默认模板
-            return self._format_default_message(product, notification_type, stock_difference, current_time)
+    def format_message(self, product, notification_type, stock_difference, config=None):
+        """使用编译好的通知模板格式化消息（模板无效时使用默认模板）"""
+        if config is None:
+            config = NotificationConfig.query.first()
         
-        # 准备模板变量
-        template_vars = {
+        variables = {
             'product_name': product.name,
             'current_stock': product.current_stock,
             'previous_stock': product.last_stock,
             'stock_difference': stock_difference,
-            'check_time': current_time,
+            'check_time': get_internet_time().strftime('%Y-%m-%d %H:%M:%S'),
             'product_url': product.url,
             'buy_url': product.buy_url or product.url
         }
+        template = get_notification_template(config, notification_type)
+        try:
+            return render_template_message(template, variables)
+        except TemplateError as e:
+            # 保存设置时已校验模板，这里只会遇到校验之前保存或从备份导入的模板
+            logger.error(f"通知模板无效，使用默认模板: {e}")
+            return render_template_message(get_notification_template(None, notification_type), variables)
+
+# 自适应检测调度
+class AdaptivePollingScheduler:
+    """商品检测调度
+    
+    - 自适应间隔：库存刚变化的商品按下限频繁检测，长期稳定的商品逐步放慢到上限
+    - 固定时间槽：每个商品在间隔内有稳定的相位，检测均匀分布在整个间隔中而不是集中在同一时刻
+    - 防止重叠：同一商品同一时间只会被一个检测任务处理
+    """
+    def __init__(self):
+        self._last_change = {}   # product_id -> 最近一次库存变化时间 (epoch 秒)
+        self._next_due = {}      # product_id -> 下次检测时间 (epoch 秒)
+        self._intervals = {}     # product_id -> 当前有效检测间隔 (秒)
+        self._in_flight = set()  # 正在检测中的商品
+        self._priority = set()   # 被重置的商品（新增、编辑或上一轮被取消），下一轮排在最前面检测
+        self._loaded = False
+        self._lock = Lock()
+        self.revision = 0        # 有效检测间隔变化时递增，用于接口缓存校验
+
+    def _ensure_loaded(self):
+        """首次使用时从库存历史加载各商品最近一次变化时间（需要应用上下文）"""
+        if self._loaded:
+            return
+        rows = db.session.query(StockHistory.product_id, db.func.max(StockHistory.timestamp))\
+            .group_by(StockHistory.product_id).all()
+        with self._lock:
+            for product_id, timestamp in rows:
+                if timestamp:
+                    self._last_change.setdefault(product_id, db_time_to_china_time(timestamp).timestamp())
+            self._loaded = True
+
+    @staticmethod
+    def get_bounds(product, default_interval):
+        """商品检测间隔上下限"""
+        min_interval = product.min_interval or default_interval
+        max_interval = product.max_interval or min(min_interval * ADAPTIVE_MAX_MULTIPLIER, MAX_CHECK_INTERVAL)
+        return min_interval, max(min_interval, max_interval)
+
+    @staticmethod
+    def _next_slot(product_id, interval, now):
+        """商品在当前间隔下的下一个时间槽：相位由商品ID决定，重启后保持不变"""
+        offset = (zlib.crc32(str(product_id).encode()) / 2 ** 32) * interval
+        return (math.floor((now - offset) / interval) + 1) * interval + offset
+
+    def _compute_interval(self, product, default_interval, now):
+        min_interval, max_interval = self.get_bounds(product, default_interval)
+        last_change = self._last_change.get(product.id)
+        if last_change is None:
+            # 从未变化过的商品以创建时间为稳定起点
+            last_change = db_time_to_china_time(product.created_at).timestamp() if product.created_at else now
+        stable_seconds = max(0.0, now - last_change)
+        return int(max(min_interval, min(max_interval, stable_seconds * ADAPTIVE_STABLE_RATIO)))
+
+    def get_interval(self, product, default_interval):
+        """商品当前的有效检测间隔"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._compute_interval(product, default_interval, time.time())
+
+    def select_due(self, products, default_interval, force=False):
+        """挑选到期需要检测的商品并标记为检测中，同时安排下一个时间槽
         
-        # 根据通知类型选择模板
-        if notification_type == "restock":
-            # 补货通知：库存增加
-            template = getattr(config, 'template_restock', 
-                             getattr(config, 'template_in_stock', 
-                                   '🎉补货通知:\n\n📦 商品名称: {product_name}\n📈 补货数量: {stock_difference} 件\n📦 当前库存: {current_stock} 件\n\n🛒 前往购买：{buy_url}'))
-        elif notification_type == "sale":
-            # 销售通知：库存减少
-            template = getattr(config, 'template_sale', 
-                             getattr(config, 'template_out_of_stock', 
-                                   '🎉销售通知:\n\n📦 商品名称: {product_name}\n📈 被购买: {stock_difference} 件\n📦 剩余库存: {current_stock} 件\n\n🛒 前往购买：{buy_url}'))
-        else:
-            # 默认使用补货模板
-            template = getattr(config, 'template_restock', 
-                             getattr(config, 'template_in_stock', 
-                                   '🎉补货通知:\n\n📦 商品名称: {product_name}\n📈 补货数量: {stock_difference} 件\n📦 当前库存: {current_stock} 件\n\n🛒 前往购买：{buy_url}'))
+        返回 (到期商品, 优先商品ID集合)：被重置的商品排在列表最前面。
+        返回的商品检测结束后必须调用 release() 释放
+        """
+        self._ensure_loaded()
+        now = time.time()
+        due = []
+        priority_ids = set()
+        with self._lock:
+            for product in products:
+                interval = self._compute_interval(product, default_interval, now)
+                if self._intervals.get(product.id) != interval:
+                    self._intervals[product.id] = interval
+                    self.revision += 1
+                if product.id in self._in_flight:
+                    continue
+                next_due = self._next_due.get(product.id)
+                if next_due is None:
+                    # 首次调度（如服务启动后）等待自己的时间槽，避免所有商品同时检测
+                    next_due = self._next_due[product.id] = self._next_slot(product.id, interval, now)
+                if force or now >= next_due:
+                    self._next_due[product.id] = self._next_slot(product.id, interval, now)
+                    self._in_flight.add(product.id)
+                    due.append(product)
+                    if product.id in self._priority:
+                        self._priority.discard(product.id)
+                        priority_ids.add(product.id)
+        # 稳定排序：优先商品在前，其余保持原有顺序
+        due.sort(key=lambda product: product.id not in priority_ids)
+        return due, priority_ids
+
+    def try_claim(self, product_id):
+        """单独检测某个商品前占用，已在检测中时返回 False"""
+        with self._lock:
+            if product_id in self._in_flight:
+                return False
+            self._in_flight.add(product_id)
+            return True
+
+    def release(self, product_id):
+        """检测结束，释放商品"""
+        with self._lock:
+            self._in_flight.discard(product_id)
+
+    def record_change(self, product_id, min_interval):
+        """记录库存变化：有效间隔回到下限，并按下限安排下一个时间槽"""
+        now = time.time()
+        with self._lock:
+            self._last_change[product_id] = now
+            self._intervals[product_id] = min_interval
+            self.revision += 1
+            self._next_due[product_id] = self._next_slot(product_id, min_interval, now)
+
+    def reset(self, product_id):
+        """商品新增、编辑或本轮被取消后，在下一次调度时立即检测"""
+        with self._lock:
+            self._next_due[product_id] = 0
+            self._priority.add(product_id)
+            self._intervals.pop(product_id, None)
+            self.revision += 1
+
+    def forget(self, product_id):
+        """商品删除后清理调度状态"""
+        with self._lock:
+            self._next_due.pop(product_id, None)
+            self._priority.discard(product_id)
+            self._intervals.pop(product_id, None)
+            self._last_change.pop(product_id, None)
+
+class DataVersions:
+    """数据版本计数器：数据变化时递增，轮询接口据此生成 ETag，未变化时返回 304"""
+    def __init__(self):
+        # 进程启动标识：重启后计数器归零，避免与浏览器中旧的 ETag 相同
+        self.boot_id = os.urandom(4).hex()
+        self._versions = {}
+        self._lock = Lock()
+
+    def bump(self, name):
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def get(self, name):
+        return self._versions.get(name, 0)
+
+data_versions = DataVersions()
+
+# 实时事件推送（SSE）
+SSE_HEARTBEAT_INTERVAL = 15        # 无事件时发送心跳的间隔（秒），用于发现已断开的连接
+SSE_MAX_STREAM_SECONDS = 300       # 单个连接的最长时长，到期后浏览器自动重连并重新校验登录状态
+SSE_RETRY_MS = 3000                # 浏览器断线重连等待时间（毫秒）
+SSE_REPLAY_LIMIT = 200             # 每次从事件表读取的最大条数
+EPHEMERAL_EVENT_CAPACITY = 50      # 内存中保留的临时消息数量
+
+class EventBroker:
+    """实时事件推送：事件写入后唤醒所有等待中的连接
+    
+    库存变化与通知事件已写入事件表，连接被唤醒后按序号读取，断线重连时按 Last-Event-ID 续传；
+    轮次完成等临时消息不落库，只在内存中保留最近的若干条。
+    """
+    def __init__(self, capacity=EPHEMERAL_EVENT_CAPACITY):
+        self.sequence = 0
+        self._ephemeral = deque(maxlen=capacity)
+        self._condition = threading.Condition()
+
+    def notify(self):
+        """事件表有新记录"""
+        with self._condition:
+            self.sequence += 1
+            self._condition.notify_all()
+
+    def publish(self, name, data):
+        """推送临时消息"""
+        with self._condition:
+            self.sequence += 1
+            self._ephemeral.append((self.sequence, name, data))
+            self._condition.notify_all()
+
+    def wait(self, sequence, timeout):
+        """等待序号变化，返回最新序号（超时未变化时返回原序号）"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.sequence != sequence, timeout)
+            return self.sequence
+
+    def ephemeral_since(self, sequence):
+        """返回 (最新序号, 该序号之后的临时消息)"""
+        with self._condition:
+            return self.sequence, [(name, data) for seq, name, data in self._ephemeral if seq > sequence]
+
+event_broker = EventBroker()
+
+class DashboardStats:
+    """仪表盘统计：启动时从数据库加载，之后随监控写入和商品增删改同步更新，读取时不访问数据库"""
+    def __init__(self):
+        self._products = {}  # product_id -> (is_active, current_stock)
+        self._counts = {'total': 0, 'active': 0, 'in_stock': 0, 'out_stock': 0}
+        self._config = {}
+        self.latest_update = None
+        self._loaded = False
+        self._lock = Lock()
+
+    def rebuild(self):
+        """从数据库重新加载全部统计（需要应用上下文）"""
+        rows = db.session.query(Product.id, Product.is_active, Product.current_stock).all()
+        latest_update = db.session.query(db.func.max(Product.updated_at)).scalar()
+        config = NotificationConfig.query.first()
+        with self._lock:
+            self._products = {}
+            self._counts = dict.fromkeys(self._counts, 0)
+            for product_id, is_active, current_stock in rows:
+                self._apply(product_id, (bool(is_active), current_stock or 0))
+            self.latest_update = latest_update
+            self._config = self._summarize_config(config)
+            self._loaded = True
+        data_versions.bump('products')
+        data_versions.bump('config')
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.rebuild()
+
+    def _apply(self, product_id, state):
+        """替换商品状态并调整计数，state 为 None 表示删除（调用方持有锁）"""
+        data_versions.bump('products')
+        for sign, current in ((-1, self._products.pop(product_id, None)), (1, state)):
+            if current is None:
+                continue
+            is_active, current_stock = current
+            self._counts['total'] += sign
+            self._counts['active'] += sign if is_active else 0
+            self._counts['in_stock'] += sign if current_stock > 0 else 0
+            self._counts['out_stock'] += sign if current_stock == 0 else 0
+        if state is not None:
+            self._products[product_id] = state
+
+    @staticmethod
+    def _summarize_config(config):
+        return {
+            'bot_configured': bool(config and config.telegram_bot_token),
+            'notification_channels': sum([
+                bool(config.channel_enabled),
+                bool(config.group_enabled),
+                bool(config.personal_enabled),
+                bool(getattr(config, 'user_enabled', False))
+            ]) if config else 0,
+            'check_interval': config.check_interval if config and config.check_interval else 120,
+            'fetch_concurrency': get_fetch_concurrency(config)
+        }
+
+    def set_product(self, product):
+        """商品新增或编辑后更新"""
+        with self._lock:
+            if self._loaded:
+                self._apply(product.id, (bool(product.is_active), product.current_stock or 0))
+
+    def set_stock(self, product_id, current_stock):
+        """库存变化后更新"""
+        with self._lock:
+            state = self._products.get(product_id)
+            if state is not None:
+                self._apply(product_id, (state[0], current_stock))
+
+    def remove_product(self, product_id):
+        with self._lock:
+            self._apply(product_id, None)
+
+    def touch(self, timestamp):
+        """记录最近的库存写入时间"""
+        with self._lock:
+            if self.latest_update is None or timestamp > self.latest_update:
+                self.latest_update = timestamp
+        data_versions.bump('products')
+
+    def set_config(self, config):
+        with self._lock:
+            self._config = self._summarize_config(config)
+        data_versions.bump('config')
+
+    def snapshot(self):
+        """当前统计数据"""
+        self._ensure_loaded()
+        with self._lock:
+            return dict(self._counts), dict(self._config), self.latest_update
+
+# 异步通知发送
+NOTIFY_WORKERS = 2                 # 通知发送线程数
+NOTIFY_QUEUE_SIZE = 1000           # 每个发送线程的队列长度上限，超出后留给发件箱重试任务发送
+
+NotificationJob = namedtuple('NotificationJob', 'chat_id row_id bot_token enqueued_at')
+
+class NotificationDispatcher:
+    """通知发送队列：通知随库存变化写入发件箱后，由独立的线程池尽快发送，发送慢不会拖慢库存检测
+    
+    同一聊天的通知总是进入同一个发送线程，按写入顺序发送；队列只是加速手段，
+    队列已满、聊天中有更早的记录需要等待或进程重启时由发件箱的重试任务发送。
+    """
+    def __init__(self, workers=NOTIFY_WORKERS, queue_size=NOTIFY_QUEUE_SIZE):
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = Lock()
+        self.stats = {'enqueued': 0, 'delivered': 0, 'deferred': 0, 'in_flight': 0,
+                      'last_latency': None, 'max_latency': None, 'total_latency': 0.0}
+
+    def start(self):
+        """启动发送线程（首次入队时自动调用）"""
+        with self._lock:
+            if self._threads:
+                return
+            for index, jobs in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(jobs,), name=f'notify-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, chat_id, row_id, bot_token):
+        """发件箱记录入队等待发送，不等待发送完成；队列已满时返回 False，记录留给重试任务发送"""
+        self.start()
+        job = NotificationJob(chat_id, row_id, bot_token, time.monotonic())
+        try:
+            self._queues[zlib.crc32(str(chat_id).encode()) % len(self._queues)].put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.stats['deferred'] += 1
+            logger.warning(f"通知队列已满，由重试任务发送: 聊天 {chat_id}")
+            return False
+        with self._lock:
+            self.stats['enqueued'] += 1
+        return True
+
+    def _run(self, jobs):
+        while True:
+            job = jobs.get()
+            with self._lock:
+                self.stats['in_flight'] += 1
+            sent = False
+            try:
+                sent = outbox.deliver(job.chat_id, job.row_id, job.bot_token)
+            except Exception as e:
+                logger.error(f"发送通知失败: 聊天 {job.chat_id}, 错误: {e}")
+            finally:
+                latency = time.monotonic() - job.enqueued_at
+                with self._lock:
+                    self.stats['in_flight'] -= 1
+                    if sent:
+                        self.stats['delivered'] += 1
+                        self.stats['last_latency'] = latency
+                        self.stats['max_latency'] = max(latency, self.stats['max_latency'] or 0)
+                        self.stats['total_latency'] += latency
+                    else:
+                        # 未由发送线程发送的记录留给重试任务，不计入发送延迟
+                        self.stats['deferred'] += 1
+                jobs.task_done()
+
+    def revision(self):
+        """入队或发送完成时变化，用于接口缓存校验"""
+        with self._lock:
+            return self.stats['enqueued'], self.stats['delivered'], self.stats['deferred']
+
+    def depth(self):
+        """等待发送的通知数量"""
+        return sum(jobs.qsize() for jobs in self._queues)
+
+    def status(self):
+        """队列状态（延迟为入队到发送完成的秒数）"""
+        with self._lock:
+            stats = dict(self.stats)
+        delivered = stats.pop('delivered')
+        total_latency = stats.pop('total_latency')
+        return {
+            'queue_depth': self.depth(),
+            'workers': len(self._queues),
+            'in_flight': stats['in_flight'],
+            'enqueued': stats['enqueued'],
+            'delivered': delivered,
+            'deferred': stats['deferred'],
+            'avg_latency_seconds': round(total_latency / delivered, 3) if delivered else None,
+            'last_latency_seconds': round(stats['last_latency'], 3) if stats['last_latency'] is not None else None,
+            'max_latency_seconds': round(stats['max_latency'], 3) if stats['max_latency'] is not None else None
+        }
+
+# 通知发件箱重试
+OutboxItem = namedtuple('OutboxItem', 'id chat_id product_name message reply_markup digest summary')
+OUTBOX_POLL_INTERVAL = 5           # 重试任务检查到期记录的频率（秒）
+OUTBOX_BATCH_SIZE = 200            # 每次重试处理的最大记录数
+OUTBOX_MAX_ATTEMPTS = 8            # 超过后标记为发送失败
+OUTBOX_BASE_DELAY = 2.0            # 第 n 次失败后等待 BASE × 2^(n-1) 秒（随机抖动，不超过上限）
+OUTBOX_MAX_DELAY = 600.0
+DIGEST_MAX_LENGTH = 3900           # 汇总消息正文长度上限（Telegram 单条消息最多 4096 字符，留出标题行），超出时拆成多条
+DIGEST_MAX_BUTTONS = 10            # 每条汇总消息最多附带的购买按钮数
+
+class OutboxSender:
+    """通知发件箱的发送与重试
+    
+    - 超时、5xx 等可重试的失败按指数退避（带随机抖动）重新安排，超过次数后标记为失败
+    - 429 限流按 Telegram 返回的 retry_after 暂停向该聊天发送，不计入重试次数
+    - 同一次通知的各聊天都有结果后写入通知日志
+    - 汇总记录在窗口到期时与同一聊天的其他汇总记录合并为一条消息发送，结果逐条写回
+    """
+    def __init__(self):
+        self._blocked_until = {}   # chat_id -> 限流解除时间 (monotonic)
+        self._lock = Lock()
+        self._finish_lock = Lock()
+        self._flush_timer = None
+        self._flush_due = 0.0
+
+    def blocked_for(self, chat_id):
+        """该聊天还需等待的限流秒数"""
+        with self._lock:
+            return max(0.0, self._blocked_until.get(chat_id, 0) - time.monotonic())
+
+    def _block(self, chat_id, seconds):
+        with self._lock:
+            self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0), time.monotonic() + seconds)
+
+    @staticmethod
+    def backoff(attempts):
+        """第 attempts 次失败后的等待秒数"""
+        delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def enqueue(self, product, notification_type, message, reply_markup, chat_ids, digest_window=0, summary=None):
+        """为每个聊天写入一条待发送记录（加入当前事务，由调用方提交），返回记录列表
         
+        digest_window 大于 0 时写入汇总记录，窗口到期后发送。
+        """
+        now = get_internet_time().replace(tzinfo=None)
+        job_id = os.urandom(8).hex()
+        rows = [NotificationOutbox(job_id=job_id, product_id=product.id, product_name=product.name,
+                                   notification_type=notification_type, chat_id=chat_id, message=message,
+                                   reply_markup=reply_markup, digest=bool(digest_window), summary=summary,
+                                   next_attempt_at=now + timedelta(seconds=digest_window), created_at=now)
+                for chat_id in chat_ids]
+        db.session.add_all(rows)
+        return rows
+
+    @staticmethod
+    def _held(now):
+        """暂时不能发送、会挡住同一聊天之后记录的条件：正在发送，或等待重试（汇总窗口未到期的首次发送不算）"""
+        return db.or_(NotificationOutbox.status == 'sending',
+                      db.and_(NotificationOutbox.status == 'pending', NotificationOutbox.next_attempt_at > now,
+                              db.or_(NotificationOutbox.digest.is_(False), NotificationOutbox.attempts > 0)))
+
+    def deliver(self, chat_id, row_id, bot_token):
+        """发送线程：按ID顺序发送该聊天到这条记录为止已到期的普通记录，返回这条记录是否已发送
+        
+        聊天限流中，或更早的记录正在发送、等待重试时不发送，留给重试任务按ID顺序发送，
+        避免新的库存通知先于旧的送达。
+        """
+        if self.blocked_for(chat_id):
+            return False
+        with app.app_context():
+            now = get_internet_time().replace(tzinfo=None)
+            held = db.session.query(db.func.min(NotificationOutbox.id))\
+                .filter(NotificationOutbox.chat_id == chat_id, self._held(now)).scalar()
+            row_ids = [due_id for (due_id,) in db.session.query(NotificationOutbox.id).filter(
+                NotificationOutbox.chat_id == chat_id, NotificationOutbox.status == 'pending',
+                NotificationOutbox.digest.is_(False), NotificationOutbox.id <= row_id,
+                db.or_(NotificationOutbox.id == row_id, NotificationOutbox.next_attempt_at <= now))
+                .order_by(NotificationOutbox.id) if held is None or due_id < held]
+            if row_id not in row_ids:
+                return False
+            # 按顺序领取，某条已被重试任务领取时停止，之后的记录留给它按顺序发送
+            items = []
+            for due_id in row_ids:
+                item = self._claim(due_id)
+                if item is None:
+                    break
+                items.append(item)
+            self._send_items(items, bot_token)
+            return any(item.id == row_id for item in items)
+
+    def deliver_due(self):
+        """重试任务：按ID顺序发送已到重试时间的记录，限流中的聊天跳过
+        
+        同一聊天中更早的记录还在等待重试或正在发送时，之后的记录也不发送，保证通知按产生顺序送达。
+        """
         try:
-            # 使用模板格式化消息
-            message = template.format(**template_vars)
-            return message
+            with app.app_context():
+                config = NotificationConfig.query.first()
+                if not config or not config.telegram_bot_token:
+                    return
+                now = get_internet_time().replace(tzinfo=None)
+                rows = db.session.query(NotificationOutbox.id, NotificationOutbox.chat_id, NotificationOutbox.digest)\
+                    .filter(NotificationOutbox.status == 'pending', NotificationOutbox.next_attempt_at <= now)\
+                    .order_by(NotificationOutbox.id).limit(OUTBOX_BATCH_SIZE).all()
+                rows = [row for row in rows if not self.blocked_for(row.chat_id)]
+                if not rows:
+                    return
+                
+                # 各聊天中最早的、暂时不能发送的记录
+                held = dict(db.session.query(NotificationOutbox.chat_id, db.func.min(NotificationOutbox.id)).filter(
+                    NotificationOutbox.chat_id.in_({row.chat_id for row in rows}), self._held(now))
+                    .group_by(NotificationOutbox.chat_id).all())
+                rows = [row for row in rows if row.id < held.get(row.chat_id, row.id + 1)]
+                row_ids = [row.id for row in rows]
+                digest_chats = {row.chat_id for row in rows if row.digest}
+                if digest_chats:
+                    # 聊天的汇总窗口到期时，窗口内之后写入的汇总记录一并发送
+                    row_ids = sorted(set(row_ids).union(row_id for row_id, chat_id in db.session.query(
+                        NotificationOutbox.id, NotificationOutbox.chat_id).filter(
+                        NotificationOutbox.status == 'pending', NotificationOutbox.digest.is_(True),
+                        NotificationOutbox.chat_id.in_(digest_chats)) if row_id < held.get(chat_id, row_id + 1)))
+                self._send_items([item for item in map(self._claim, row_ids) if item], config.telegram_bot_token)
         except Exception as e:
-            logger.error(f"模板格式化失败: {e}")
-            # 使用内置默认模板作为后备
-            if notification_type == "restock":
-                return f"📦 补货通知\n\n【{product.name}】补货 {stock_difference} 件\n\n📦 当前库存：{product.current_stock} 件\n🕐 检测时间：{current_time}" + (f"\n\n🛒 前往购买：{product.buy_url}" if product.buy_url else "")
-            elif notification_type == "sale":
-                return f"🛒 销售通知\n\n【{product.name}】被购买 {stock_difference} 件\n\n📦 当前库存：{product.current_stock} 件\n🕐 检测时间：{current_time}" + (f"\n\n🛒 前往购买：{product.buy_url}" if product.buy_url else "")
+            logger.error(f"通知重试失败: {e}")
+
+    def schedule_flush(self, delay):
+        """在 delay 秒后发送到期的汇总记录（已有更早的定时发送时不重复安排）"""
+        due = time.monotonic() + delay
+        with self._lock:
+            if self._flush_timer is not None and self._flush_timer.is_alive() and self._flush_due <= due:
+                return
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+            self._flush_timer = threading.Timer(delay, self._flush)
+            self._flush_timer.daemon = True
+            self._flush_due = due
+            self._flush_timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._flush_timer = None
+        self.deliver_due()
+        try:
+            with app.app_context():
+                next_due = db.session.query(db.func.min(NotificationOutbox.next_attempt_at))\
+                    .filter(NotificationOutbox.status == 'pending', NotificationOutbox.digest.is_(True)).scalar()
+            if next_due is not None:
+                delay = (next_due - get_internet_time().replace(tzinfo=None)).total_seconds()
+                self.schedule_flush(max(delay, 0.5))
+        except Exception as e:
+            logger.error(f"安排汇总通知发送失败: {e}")
+
+    def _claim(self, row_id):
+        """把待发送的记录标记为发送中并返回发送所需的数据，已被其他线程领取时返回 None"""
+        claimed = db.session.execute(db.update(NotificationOutbox)
+                                     .where(NotificationOutbox.id == row_id, NotificationOutbox.status == 'pending')
+                                     .values(status='sending'))
+        db.session.commit()
+        if claimed.rowcount != 1:
+            return None
+        row = db.session.get(NotificationOutbox, row_id)
+        return OutboxItem(row.id, row.chat_id, row.product_name, row.message, row.reply_markup, row.digest, row.summary)
+
+    @staticmethod
+    def digest_messages(items):
+        """把同一聊天的汇总记录合并为消息 [(记录, 文本, 内联按钮)]，超过长度上限时拆成多条"""
+        if not items:
+            return []
+        chunks = [[]]
+        length = 0
+        for item in items:
+            line = item.summary or item.message
+            if chunks[-1] and length + len(line) + 1 > DIGEST_MAX_LENGTH:
+                chunks.append([])
+                length = 0
+            chunks[-1].append(item)
+            length += len(line) + 1
+        
+        check_time = get_internet_time().strftime('%Y-%m-%d %H:%M:%S')
+        messages = []
+        for chunk in chunks:
+            lines = [f"📋 库存变化汇总（{len(chunk)} 条）", ""]
+            lines += [item.summary or item.message for item in chunk]
+            lines += ["", f"🕐 检测时间：{check_time}"]
+            
+            buttons = []
+            for item in chunk:
+                keyboard = json.loads(item.reply_markup)['inline_keyboard'] if item.reply_markup else []
+                for button in (button for row in keyboard for button in row):
+                    if len(buttons) < DIGEST_MAX_BUTTONS and button['url'] not in {b['url'] for b in buttons}:
+                        buttons.append({'text': f"🛒 {(item.product_name or '')[:30]}", 'url': button['url']})
+            reply_markup = json.dumps({'inline_keyboard': [[button] for button in buttons]}) if buttons else None
+            messages.append((chunk, '\n'.join(lines)[:4096], reply_markup))
+        return messages
+
+    def _send_items(self, items, bot_token):
+        """按聊天分组，在 Telegram 客户端的线程池中并行发送，结果在当前线程写回数据库"""
+        by_chat = {}
+        for item in items:
+            by_chat.setdefault(item.chat_id, []).append(item)
+        
+        def send_chat(chat_items):
+            # 普通记录各发一条，汇总记录合并发送；合并的记录共用同一个发送结果
+            messages = [([item], item.message, item.reply_markup) for item in chat_items if not item.digest]
+            messages += self.digest_messages([item for item in chat_items if item.digest])
+            messages.sort(key=lambda message: message[0][0].id)
+            results = []
+            halted = False
+            for records, text, reply_markup in messages:
+                # 同一聊天前一条触发限流或需要重试时，剩余的记录留到它之后按顺序发送
+                if halted or self.blocked_for(records[0].chat_id):
+                    results += [(item, None) for item in records]
+                    continue
+                result = telegram.send_message(bot_token, records[0].chat_id, text, reply_markup)
+                if result.retry_after:
+                    self._block(records[0].chat_id, result.retry_after)
+                halted = not result.ok and not result.permanent
+                results += [(item, result) for item in records]
+            return results
+        
+        for results in telegram.fan_out(send_chat, by_chat.values()):
+            for item, result in results:
+                self._record_result(item, result)
+
+    def _reschedule(self, row, delay, error):
+        row.status = 'pending'
+        row.next_attempt_at = get_internet_time().replace(tzinfo=None) + timedelta(seconds=delay)
+        row.last_error = error[:500] if error else row.last_error
+        db.session.commit()
+
+    def _record_result(self, item, result):
+        """写回一条记录的发送结果（result 为 None 表示未发送：聊天限流中，或同一聊天更早的记录需要重试）"""
+        row = db.session.get(NotificationOutbox, item.id)
+        if result is None:
+            self._reschedule(row, self.blocked_for(item.chat_id), None)
+            return
+        if result.retry_after:
+            logger.warning(f"Telegram 限流: 聊天 {row.chat_id} 需等待 {result.retry_after} 秒")
+            self._reschedule(row, result.retry_after, result.error)
+            return
+        
+        row.attempts += 1
+        if not result.ok and not result.permanent and row.attempts < OUTBOX_MAX_ATTEMPTS:
+            delay = self.backoff(row.attempts)
+            logger.warning(f"发送消息到 {row.chat_id} 失败（第 {row.attempts} 次），{delay:.1f} 秒后重试: {result.error}")
+            self._reschedule(row, delay, result.error)
+            return
+        
+        with self._finish_lock:
+            if result.ok:
+                row.status = 'sent'
+                row.sent_at = get_internet_time().replace(tzinfo=None)
+                logger.info(f"消息发送成功到 {row.chat_id}")
             else:
-                return f"📊 【{product.name}】库存变化\n\n📦 当前库存：{product.current_stock} 件\n📊 变化数量：{stock_difference:+d}\n\n🕐 检测时间：{current_time}" + (f"\n\n🛒 前往购买：{product.buy_url}" if product.buy_url else "")
-    
-    def _format_default_message(self, product, notification_type, stock_difference, current_time):
-        """默认消息格式"""
-        if notification_type == "restock":
-            message = f"🎉 补货通知\n📦 商品名称: {product.name}\n📈 补货数量: {stock_difference}\n📊 当前库存: {product.current_stock}"
-        elif notification_type == "sale":
-            message = f"🎉 销售通知\n📦 商品名称: {product.name}\n📈 被购买: {abs(stock_difference)}\n📊 剩余库存: {product.current_stock}"
+                row.status = 'failed'
+                row.last_error = (result.error or '')[:500]
+                logger.error(f"发送消息到 {row.chat_id} 失败，不再重试: {result.error}")
+            db.session.commit()
+            self._finish_job(row)
+
+    def _finish_job(self, row):
+        """同一次通知的所有聊天都有结果后记录通知日志（调用方持有 _finish_lock）"""
+        statuses = [status for (status,) in db.session.query(NotificationOutbox.status)
+                    .filter(NotificationOutbox.job_id == row.job_id)]
+        if any(status in ('pending', 'sending') for status in statuses):
+            return
+        sent_count = statuses.count('sent')
+        if sent_count:
+            notifier._log_notification(row.product_id, row.product_name, row.notification_type, row.message, "sent")
+            logger.info(f"通知发送成功: {row.product_name}, 发送到 {sent_count} 个渠道")
         else:
-            # 兼容旧的通知类型
-            message = f"🎉 库存变化\n📦 商品名称: {product.name}\n📊 当前库存: {product.current_stock}\n📈 变化数量: {stock_difference}"
-        
-        # 不在消息文本中添加购买链接，因为会通过按钮显示
-        return message
+            notifier._log_notification(row.product_id, row.product_name, row.notification_type, row.message, "failed")
+            logger.error(f"通知发送失败: {row.product_name}, 所有渠道均失败")
+
+    def recover(self):
+        """启动时把上次退出时仍在发送中的记录恢复为待发送（可能重复发送一次，但不会丢失）"""
+        recovered = db.session.execute(db.update(NotificationOutbox)
+                                       .where(NotificationOutbox.status == 'sending')
+                                       .values(status='pending'))
+        db.session.commit()
+        pending = NotificationOutbox.query.filter_by(status='pending').count()
+        if pending:
+            logger.info(f"通知发件箱: 待发送 {pending} 条（其中恢复发送中 {recovered.rowcount} 条）")
+
+    def status(self):
+        """发件箱状态"""
+        counts = dict(db.session.query(NotificationOutbox.status, db.func.count())
+                      .filter(NotificationOutbox.status.in_(['pending', 'sending']))
+                      .group_by(NotificationOutbox.status).all())
+        with self._lock:
+            now = time.monotonic()
+            blocked = {chat_id: round(until - now, 1) for chat_id, until in self._blocked_until.items() if until > now}
+        return {
+            'pending': counts.get('pending', 0),
+            'sending': counts.get('sending', 0),
+            'rate_limited_chats': blocked
+        }
+
+def schedule_outbox_job():
+    """注册通知重试任务"""
+    scheduler.add_job(
+        func=outbox.deliver_due,
+        trigger="interval",
+        seconds=OUTBOX_POLL_INTERVAL,
+        id='outbox_job',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
 
 # 全局对象
 monitor = InventoryMonitorV2()
 notifier = TelegramNotifierV2()
+telegram = TelegramClient()
+notification_dispatcher = NotificationDispatcher()
+outbox = OutboxSender()
 scheduler = BackgroundScheduler()
+adaptive_scheduler = AdaptivePollingScheduler()
+dashboard_stats = DashboardStats()
 
 def send_telegram_notification(message, chat_id, bot_token):
     """发送Telegram通知的辅助函数"""
-    try:
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        data = {
-            'chat_id': chat_id,
-            'text': message,
-            'parse_mode': 'Markdown',
-            'disable_web_page_preview': False
-        }
-        
-        response = requests.post(url, data=data, timeout=10)
-        response.raise_for_status()
-        
-        result = response.json()
-        if result.get('ok'):
-            return True
-        else:
-            logger.error(f"Telegram API错误: {result}")
-            return False
+    result = telegram.send_message(bot_token, chat_id, message, disable_web_page_preview=False)
+    if not result.ok:
+        logger.error(f"发送消息失败: {result.error}")
+    return result.ok
+
+# 最近一轮监控统计
+last_round_stats = {}
+
+def get_fetch_concurrency(config):
+    """读取并发检测数量配置"""
+    concurrency = getattr(config, 'fetch_concurrency', None) if config else None
+    if not concurrency:
+        return DEFAULT_FETCH_CONCURRENCY
+    return max(1, min(int(concurrency), MAX_FETCH_CONCURRENCY))
+
+def get_host_politeness(config):
+    """读取站点礼貌访问配置: (单站点并发上限, 同站点请求间隔秒数)"""
+    max_concurrency = getattr(config, 'per_host_concurrency', None) if config else None
+    min_interval = getattr(config, 'per_host_interval', None) if config else None
+    if not max_concurrency:
+        max_concurrency = DEFAULT_PER_HOST_CONCURRENCY
+    if min_interval is None:
+        min_interval = DEFAULT_PER_HOST_INTERVAL
+    return (max(1, min(int(max_concurrency), MAX_PER_HOST_CONCURRENCY)),
+            max(0.0, min(float(min_interval), MAX_PER_HOST_INTERVAL)))
+
+def interleave_by_host(products, priority_ids=()):
+    """按站点轮转排列商品，避免同一站点的商品集中占满工作线程
+    
+    priority_ids 中的商品单独轮转后排在最前面，保证先于其他商品开始检测
+    """
+    def interleave(items):
+        groups = {}
+        for product in items:
+            groups.setdefault(get_url_host(product.url), []).append(product)
+        return [p for batch in zip_longest(*groups.values()) for p in batch if p is not None]
+    
+    return interleave([p for p in products if p.id in priority_ids]) + \
+        interleave([p for p in products if p.id not in priority_ids])
+
+def get_default_interval(config):
+    """全局检测间隔（作为商品检测间隔的默认下限）"""
+    return config.check_interval if config and config.check_interval else 120
+
+def get_round_deadline(config):
+    """单轮监控的截止时长（秒）：不超过全局检测间隔，避免轮次堆积"""
+    return max(SCHEDULER_TICK_SECONDS, get_default_interval(config))
+
+def process_product_v2(product, config, buffer, cancel_event=None):
+    """检查单个商品并将结果放入写缓冲，返回处理结果: checked / not_modified / failed / cancelled
+    
+    库存是否变化在写缓冲提交时判断，通知也在提交后发送
+    """
+    with app.app_context():
+        try:
+            if cancel_event is not None and cancel_event.is_set():
+                raise CheckCancelled()
             
-    except Exception as e:
-        logger.error(f"发送消息失败: {e}")
+            logger.info(f"--- 检查商品: {product.name} ---")
+            
+            # 检测使用的网址与选择器对应的版本号，提交时商品已被编辑则丢弃本次结果
+            version = product.version
+            
+            # 检查新库存（条件请求）
+            result = monitor.fetch_stock(product, cancel_event=cancel_event)
+            
+            if result.not_modified:
+                # 页面未变化：跳过解析与库存写入
+                if result.validators:
+                    buffer.add_validators(product.id, result.validators, version)
+                return 'not_modified'
+            
+            new_stock = result.stock
+            if new_stock is None:
+                logger.warning(f"无法获取 {product.name} 的库存信息")
+                return 'failed'
+            
+            buffer.add_stock(product.id, new_stock, result.validators, version)
+            return 'checked'
+            
+        except CheckCancelled:
+            logger.warning(f"本轮已超时，放弃检测: {product.name}")
+            adaptive_scheduler.reset(product.id)
+            return 'cancelled'
+        except Exception as e:
+            logger.error(f"处理商品 {product.name} 时出错: {e}")
+            import traceback
+            traceback.print_exc()
+            return 'failed'
+
+# 监控轮次锁：同一时间只运行一轮监控
+round_lock = Lock()
+
+def monitor_all_products_v2(force=False):
+    """监控到期的商品 - 重构版本（支持并发检测与自适应间隔）
+    
+    调度器每 SCHEDULER_TICK_SECONDS 秒调用一次，只检测已到检测时间的商品；force=True 时检测全部活跃商品。
+    上一轮尚未结束时直接返回 False；超过截止时间仍未完成的检测会被取消，并在下一轮优先检测。
+    """
+    if not round_lock.acquire(blocking=False):
+        logger.info("上一轮监控仍在进行，跳过本次调度")
         return False
+    
+    try:
+        run_monitor_round(force)
+        return True
+    finally:
+        round_lock.release()
 
-def monitor_all_products_v2():
-    """监控所有商品 - 重构版本"""
-    current_time = get_internet_time().strftime('%Y-%m-%d %H:%M:%S')
-    logger.info(f"========== 开始新一轮监控 [{current_time}] ==========")
+def run_monitor_round(force=False):
+    """执行一轮监控"""
+    round_started = time.monotonic()
+    results = {'checked': 0, 'not_modified': 0, 'failed': 0, 'cancelled': 0}
+    products = []
+    config = None
+    buffer = StockWriteBuffer()
+    concurrency = 1
+    deadline = SCHEDULER_TICK_SECONDS
+    cancel_event = threading.Event()
     
     try:
         with app.app_context():
-            products = Product.query.filter_by(is_active=True).all()
+            active_products = Product.query.filter_by(is_active=True).all()
             config = NotificationConfig.query.first()
+            products, priority_ids = adaptive_scheduler.select_due(active_products, get_default_interval(config), force)
+            if not products:
+                logger.debug("没有到期需要检测的商品")
+                return
             
-            logger.info(f"活跃商品数量: {len(products)}")
-            logger.info(f"通知配置状态: {'已配置' if config and config.telegram_bot_token else '未配置'}")
+            concurrency = get_fetch_concurrency(config)
+            deadline = get_round_deadline(config)
+            buffer.config = config
+            monitor.hosts.configure(*get_host_politeness(config))
             
-            for product in products:
-                try:
-                    logger.info(f"--- 检查商品: {product.name} ---")
-                    
-                    # 检查新库存
-                    new_stock = monitor.check_stock(product)
-                    
-                    if new_stock is not None:
-                        # 安全更新库存
-                        stock_changed, old_stock, updated_new_stock = monitor.update_stock_safe(product.id, new_stock)
-                        
-                        if stock_changed and config:
-                            # 判断是否需要发送通知
-                            should_notify, notification_type, stock_difference = notifier.should_send_notification(old_stock, updated_new_stock)
-                            
-                            if should_notify:
-                                logger.info(f"准备发送通知: {notification_type}")
-                                notifier.send_notification(config, product, notification_type, stock_difference)
-                            else:
-                                logger.info("不需要发送通知")
-                        else:
-                            if not stock_changed:
-                                logger.info("库存无变化，跳过通知")
-                            if not config:
-                                logger.info("未配置通知，跳过")
-                    else:
-                        logger.warning(f"无法获取 {product.name} 的库存信息")
-                        
-                except Exception as e:
-                    logger.error(f"处理商品 {product.name} 时出错: {e}")
-                    import traceback
-                    traceback.print_exc()
-                
-                # 商品间添加延迟
-                time.sleep(1)
+            # 商品与配置对象会在工作线程中读取，脱离会话避免跨线程访问
+            db.session.expunge_all()
+        
+        current_time = get_internet_time().strftime('%Y-%m-%d %H:%M:%S')
+        logger.info(f"========== 开始新一轮监控 [{current_time}] ==========")
+        
+        products = interleave_by_host(products, priority_ids)
+        
+        logger.info(f"到期商品数量: {len(products)}/{len(active_products)}, 站点数量: {len({get_url_host(p.url) for p in products})}, 并发数: {concurrency}, 截止时长: {deadline}秒")
+        logger.info(f"通知配置状态: {'已配置' if config and config.telegram_bot_token else '未配置'}")
+        
+        # 超过截止时间后通知所有检测主动放弃（等待中的站点槽位和流式读取都会检查该标志）
+        timer = threading.Timer(deadline, cancel_event.set)
+        timer.daemon = True
+        timer.start()
+        try:
+            if concurrency <= 1:
+                # 同站点请求间隔由 HostDispatcher 保证
+                for product in products:
+                    results[process_product_v2(product, config, buffer, cancel_event)] += 1
+            else:
+                with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='monitor') as executor:
+                    futures = [executor.submit(process_product_v2, product, config, buffer, cancel_event) for product in products]
+                    wait_futures(futures)
+                    for future in futures:
+                        results[future.result()] += 1
+        finally:
+            timer.cancel()
                 
     except Exception as e:
         logger.error(f"监控过程出错: {e}")
         import traceback
         traceback.print_exc()
+        if not products:
+            return
+    finally:
+        # 提交剩余的检测结果后再释放商品，避免下一次检测读到未写入的旧库存
+        buffer.flush()
+        for product in products:
+            adaptive_scheduler.release(product.id)
+    
+    duration = time.monotonic() - round_started
+    last_round_stats.update({
+        'finished_at': get_internet_time().isoformat(),
+        'duration_seconds': round(duration, 2),
+        'deadline_seconds': deadline,
+        'product_count': len(products),
+        'concurrency': concurrency,
+        'changed': buffer.results['changed'],
+        'unchanged': buffer.results['unchanged'],
+        'not_modified': results['not_modified'],
+        'failed': results['failed'],
+        'cancelled': results['cancelled']
+    })
+    event_broker.publish('round_complete', dict(last_round_stats))
     
+    if results['cancelled']:
+        logger.warning(f"本轮超过截止时长 {deadline} 秒，{results['cancelled']} 个商品未完成检测，将在下一轮优先检测")
+    logger.info(f"本轮耗时 {duration:.2f} 秒, 商品 {len(products)} 个, 变化 {buffer.results['changed']}, 无变化 {buffer.results['unchanged']}, 页面未变化 {results['not_modified']}, 失败 {results['failed']}, 取消 {results['cancelled']}")
     logger.info(f"========== 监控轮次结束 [{get_internet_time().strftime('%Y-%m-%d %H:%M:%S')}] ==========")
 
 # 动态更新调度器
 def update_scheduler_v2():
-    """更新调度器间隔"""
+    """更新调度器：定时检查到期商品，各商品按自身的有效间隔检测"""
     try:
         with app.app_context():
             config = NotificationConfig.query.first()
-            # 现在check_interval直接存储秒数
-            interval_seconds = config.check_interval if config and config.check_interval else 120
+            # 现在check_interval直接存储秒数，作为商品检测间隔的默认下限
+            interval_seconds = get_default_interval(config)
         
         # 移除现有任务
         try:
@@ -724,16 +2562,97 @@ def update_scheduler_v2():
             pass
             
         # 添加新任务 - 使用秒级精度
+        # 允许两个实例：上一轮未结束时新实例会因轮次锁立即返回，避免 APScheduler 丢弃任务并告警
         scheduler.add_job(
             func=monitor_all_products_v2,
             trigger="interval",
-            seconds=interval_seconds,
-            id='monitor_job_v2'
+            seconds=SCHEDULER_TICK_SECONDS,
+            id='monitor_job_v2',
+            max_instances=2,
+            coalesce=True
         )
-        logger.info(f"调度器已更新，检测间隔：{interval_seconds}秒")
+        logger.info(f"调度器已更新，默认检测间隔：{interval_seconds}秒，每{SCHEDULER_TICK_SECONDS}秒检查到期商品")
     except Exception as e:
         logger.error(f"更新调度器失败: {e}")
 
+def delete_in_chunks(model, *conditions):
+    """分批删除符合条件的记录，每批单独提交并短暂让出数据库，避免长时间阻塞监控写入"""
+    deleted = 0
+    while True:
+        with app.app_context():
+            ids = db.session.query(model.id).filter(*conditions).order_by(model.id).limit(PRUNE_CHUNK_SIZE).subquery()
+            count = model.query.filter(model.id.in_(db.select(ids.c.id))).delete(synchronize_session=False)
+            db.session.commit()
+        deleted += count
+        if count < PRUNE_CHUNK_SIZE:
+            return deleted
+        time.sleep(PRUNE_CHUNK_PAUSE)
+
+def incremental_vacuum():
+    """分批回收删除记录后留下的空闲页"""
+    reclaimed = 0
+    with app.app_context():
+        while True:
+            with db.engine.connect() as conn:
+                free_pages = conn.exec_driver_sql('PRAGMA freelist_count').scalar() or 0
+                if not free_pages:
+                    return reclaimed
+                # 该 PRAGMA 每执行一步只回收一页，sqlite3 的 execute 只执行一步，需用 executescript 执行到结束
+                conn.commit()
+                conn.connection.driver_connection.executescript(f'PRAGMA incremental_vacuum({VACUUM_CHUNK_PAGES})')
+            reclaimed += min(free_pages, VACUUM_CHUNK_PAGES)
+            if free_pages <= VACUUM_CHUNK_PAGES:
+                return reclaimed
+            time.sleep(PRUNE_CHUNK_PAUSE)
+
+def get_retention_days(config):
+    """库存历史与通知记录的保留天数"""
+    history_days = getattr(config, 'history_retention_days', None) if config else None
+    notification_days = getattr(config, 'notification_retention_days', None) if config else None
+    return (
+        DEFAULT_HISTORY_RETENTION_DAYS if history_days is None else history_days,
+        DEFAULT_NOTIFICATION_RETENTION_DAYS if notification_days is None else notification_days
+    )
+
+def prune_old_records():
+    """按保留策略清理过期的库存历史与通知记录（按小时/按天的汇总数据保留，用于长期图表）"""
+    try:
+        with app.app_context():
+            history_days, notification_days = get_retention_days(NotificationConfig.query.first())
+        
+        now = get_internet_time().replace(tzinfo=None)
+        history_deleted = notification_deleted = 0
+        if history_days > 0:
+            cutoff = now - timedelta(days=history_days)
+            history_deleted = delete_in_chunks(StockHistory, StockHistory.timestamp < cutoff)
+            delete_in_chunks(Event, Event.event_type == 'stock_change', Event.timestamp < cutoff)
+        if notification_days > 0:
+            cutoff = now - timedelta(days=notification_days)
+            notification_deleted = delete_in_chunks(NotificationLog, NotificationLog.timestamp < cutoff)
+            delete_in_chunks(Event, Event.event_type == 'notification', Event.timestamp < cutoff)
+            delete_in_chunks(NotificationOutbox, NotificationOutbox.status.in_(['sent', 'failed']),
+                             NotificationOutbox.created_at < cutoff)
+        
+        if history_deleted or notification_deleted:
+            data_versions.bump('events')
+        reclaimed = incremental_vacuum() if history_deleted or notification_deleted else 0
+        if history_deleted or notification_deleted:
+            logger.info(f"日志清理完成: 库存历史 {history_deleted} 条, 通知记录 {notification_deleted} 条, 回收 {reclaimed} 页")
+    except Exception as e:
+        logger.error(f"日志清理失败: {e}")
+
+def schedule_retention_job():
+    """注册日志清理任务"""
+    scheduler.add_job(
+        func=prune_old_records,
+        trigger="interval",
+        seconds=RETENTION_JOB_INTERVAL,
+        id='retention_job',
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+
 # 模板过滤器
 @app.template_filter('china_time')
 def china_time_filter(dt):
@@ -912,8 +2831,7 @@ def api_change_password():
         # 设置新密码
         user.set_password(new_password)
         
-        with db_lock:
-            db.session.commit()
+        db.session.commit()
         
         logger.info(f"用户 {user.username} 成功修改密码")
         return jsonify({'success': True, 'message': '密码修改成功'})
@@ -933,7 +2851,10 @@ def index():
     if config:
         logger.info(f"首页加载 - 个人通知配置: user_enabled={getattr(config, 'user_enabled', 'N/A')}, user_id={getattr(config, 'user_id', 'N/A')}, personal_enabled={getattr(config, 'personal_enabled', 'N/A')}")
     
-    return render_template('index.html', products=products, config=config)
+    default_interval = get_default_interval(config)
+    intervals = {p.id: adaptive_scheduler.get_interval(p, default_interval) for p in products}
+    
+    return render_template('index.html', products=products, config=config, intervals=intervals)
 
 @app.route('/debug/config')
 def debug_config():
@@ -987,9 +2908,7 @@ def test_selector():
                 'error': 'URL格式无效'
             })
         
-        # 使用监控类测试选择器
-        monitor = InventoryMonitorV2()
-        
+        # 使用全局监控实例测试选择器，遵循站点并发上限、请求间隔并复用连接池
         # 创建临时Product对象用于测试
         temp_product = type('TempProduct', (), {
             'name': '测试商品',
@@ -1096,6 +3015,14 @@ def get_page_title():
             'error': '获取标题失败，请手动输入'
         }), 500
 
+def parse_interval_field(value):
+    """解析商品检测间隔输入（秒），为空时返回 None 表示使用默认值"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return max(MIN_CHECK_INTERVAL, min(value, MAX_CHECK_INTERVAL))
+
 @app.route('/add_product', methods=['GET', 'POST'])
 @login_required
 def add_product():
@@ -1111,10 +3038,15 @@ def add_product():
             url=url,
             target_selector=request.form['target_selector'],
             threshold=int(request.form.get('threshold', 1)),
-            buy_url=buy_url
+            buy_url=buy_url,
+            needs_full_document='needs_full_document' in request.form,
+            min_interval=parse_interval_field(request.form.get('min_interval')),
+            max_interval=parse_interval_field(request.form.get('max_interval'))
         )
         db.session.add(product)
         db.session.commit()
+        adaptive_scheduler.reset(product.id)
+        dashboard_stats.set_product(product)
         flash('商品添加成功!', 'success')
         return redirect(url_for('products'))
     
@@ -1127,6 +3059,12 @@ def edit_product(id):
     product = Product.query.get_or_404(id)
     
     if request.method == 'POST':
+        # 监控地址或选择器变化后，旧的页面缓存校验信息失效
+        if product.url != request.form['url'] or product.target_selector != request.form['target_selector']:
+            product.etag = None
+            product.last_modified = None
+            product.content_hash = None
+        
         product.name = request.form['name']
         product.url = request.form['url']
         product.target_selector = request.form['target_selector']
@@ -1140,7 +3078,22 @@ def edit_product(id):
         
         product.is_active = 'is_active' in request.form
         
+        # 解析方式变化后内容哈希的覆盖范围不同，需要重新计算
+        needs_full_document = 'needs_full_document' in request.form
+        if bool(product.needs_full_document) != needs_full_document:
+            product.content_hash = None
+        product.needs_full_document = needs_full_document
+        
+        product.min_interval = parse_interval_field(request.form.get('min_interval'))
+        product.max_interval = parse_interval_field(request.form.get('max_interval'))
+        
+        # 版本号变化后，编辑前开始的检测结果不会覆盖这里清空的校验信息
+        product.version = (product.version or 0) + 1
+        
         db.session.commit()
+        monitor.selectors.invalidate(id)
+        adaptive_scheduler.reset(id)
+        dashboard_stats.set_product(product)
         flash('商品更新成功!', 'success')
         return redirect(url_for('products'))
     
@@ -1154,39 +3107,88 @@ def delete_product(id):
     
     # 删除相关的历史记录和通知日志
     StockHistory.query.filter_by(product_id=id).delete()
+    StockRollup.query.filter_by(product_id=id).delete()
     NotificationLog.query.filter_by(product_id=id).delete()
     
     db.session.delete(product)
     db.session.commit()
+    monitor.selectors.invalidate(id)
+    adaptive_scheduler.forget(id)
+    dashboard_stats.remove_product(id)
     
     flash('商品删除成功!', 'success')
     return redirect(url_for('products'))
 
+# 库存历史图表：时间范围不超过该天数时直接读取原始记录，否则读取对应粒度的汇总
+HISTORY_RAW_MAX_DAYS = 2
+HISTORY_HOURLY_MAX_DAYS = 90
+HISTORY_RAW_LIMIT = 2000
+
+def choose_history_resolution(days):
+    """根据时间跨度选择数据粒度，使返回的数据点数量大致稳定"""
+    if days <= HISTORY_RAW_MAX_DAYS:
+        return 'raw'
+    if days <= HISTORY_HOURLY_MAX_DAYS:
+        return 'hour'
+    return 'day'
+
 @app.route('/api/stock_history/<int:product_id>')
 @login_required
 def get_stock_history(product_id):
-    """获取商品库存历史"""
+    """获取商品库存历史
+    
+    不带参数时返回最近30条变化记录；带 days 参数时返回该时间范围内的数据，
+    并根据跨度自动选择原始记录、按小时或按天汇总
+    """
     try:
         product = Product.query.get_or_404(product_id)
+        days = request.args.get('days', type=float)
         
-        # 获取最近30条历史记录
-        histories = StockHistory.query.filter_by(product_id=product_id)\
-            .order_by(StockHistory.timestamp.desc())\
-            .limit(30).all()
+        if not days or days <= 0:
+            # 获取最近30条历史记录
+            resolution = 'raw'
+            histories = StockHistory.query.filter_by(product_id=product_id)\
+                .order_by(StockHistory.timestamp.desc())\
+                .limit(30).all()
+        else:
+            resolution = choose_history_resolution(days)
+            since = get_internet_time().replace(tzinfo=None) - timedelta(days=days)
+            if resolution == 'raw':
+                histories = StockHistory.query.filter(StockHistory.product_id == product_id, StockHistory.timestamp >= since)\
+                    .order_by(StockHistory.timestamp.desc())\
+                    .limit(HISTORY_RAW_LIMIT).all()
+            else:
+                histories = StockRollup.query.filter(StockRollup.product_id == product_id,
+                                                     StockRollup.resolution == resolution,
+                                                     StockRollup.bucket_start >= ROLLUP_RESOLUTIONS[resolution](since))\
+                    .order_by(StockRollup.bucket_start.desc()).all()
         
         # 格式化历史数据
         history_data = []
         for history in histories:
-            history_data.append({
-                'id': history.id,
-                'stock_count': history.stock_count,
-                'timestamp': db_time_to_china_time(history.timestamp).strftime('%Y-%m-%d %H:%M:%S'),
-                'change_type': history.change_type or 'unknown'
-            })
+            if resolution == 'raw':
+                history_data.append({
+                    'id': history.id,
+                    'stock_count': history.stock_count,
+                    'timestamp': db_time_to_china_time(history.timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+                    'change_type': history.change_type or 'unknown'
+                })
+            else:
+                history_data.append({
+                    'stock_count': history.close_stock,
+                    'timestamp': history.bucket_start.strftime('%Y-%m-%d %H:%M:%S'),
+                    'open_stock': history.open_stock,
+                    'min_stock': history.min_stock,
+                    'max_stock': history.max_stock,
+                    'restock_units': history.restock_units,
+                    'sold_units': history.sold_units,
+                    'change_count': history.change_count
+                })
         
         return jsonify({
             'success': True,
             'product_name': product.name,
+            'resolution': resolution,
             'histories': history_data
         })
         
@@ -1197,6 +3199,162 @@ def get_stock_history(product_id):
             'error': str(e)
         }), 500
 
+# 库存分析
+DEFAULT_ANALYTICS_DAYS = 7
+MAX_ANALYTICS_DAYS = 365
+SECONDS_PER_HOUR = 3600
+
+def fetch_columns(sql, params, width):
+    """用 SQLite 游标读取整数列，不创建 ORM 对象，返回 (行数, width) 的数组"""
+    cursor = db.session.connection().connection.driver_connection.execute(sql, params)
+    return np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, width)
+
+def load_analytics_columns(since, product_id=None):
+    """按列读取分析所需的数据（时间戳为中国时间按 UTC 换算的秒数，取余即可得到小时）
+    
+    - 按小时汇总: (商品ID, 时段起点, 售出件数, 补货件数, 变化次数)，数量只与商品数 × 小时数有关
+    - 原始记录中的补货与售罄: (商品ID, 变化前库存, 变化后库存, 时间)，按商品、时间排序
+    """
+    product_filter, params = (" AND product_id = ?", [product_id]) if product_id else ("", [])
+    rollups = fetch_columns(
+        "SELECT product_id, CAST(strftime('%s', bucket_start) AS INTEGER), sold_units, restock_units, change_count "
+        f"FROM {StockRollup.__tablename__} WHERE resolution = 'hour' AND bucket_start >= ?{product_filter}",
+        [since.isoformat(' ')] + params, 5)
+    events = fetch_columns(
+        "SELECT product_id, COALESCE(previous_stock, 0), stock_count, CAST(strftime('%s', timestamp) AS INTEGER) "
+        f"FROM {StockHistory.__tablename__} "
+        f"WHERE timestamp >= ? AND (stock_count > COALESCE(previous_stock, 0) OR stock_count = 0){product_filter}",
+        [since.isoformat(' ')] + params, 4)
+    events = events[np.lexsort((events[:, 3], events[:, 0]))]
+    return rollups, events
+
+def group_mean(groups, values, size):
+    """按组求平均值，没有数据的组为 NaN"""
+    counts = np.bincount(groups, minlength=size)
+    sums = np.bincount(groups, weights=values, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts, counts
+
+def compute_stock_analytics(days, product_id=None):
+    """计算库存分析指标（整列向量化计算）
+    
+    - 销售速度: 时间范围内售出件数 / 小时数
+    - 售罄时长: 每次补货后到库存降为 0 的时间（之间又补货则不计）
+    - 补货频率: 补货次数 / 天数，以及相邻两次补货的平均间隔
+    - 时段分布: 按中国时间小时统计的售出件数与补货次数
+    
+    件数与时段分布读取按小时汇总，补货与售罄只读取原始记录中对应的变化，
+    普通的销售变化不需要逐条读取。调用方需保证 days 不超过库存历史的保留天数。
+    """
+    since = ROLLUP_RESOLUTIONS['hour'](get_internet_time().replace(tzinfo=None) - timedelta(days=days))
+    rollups, events = load_analytics_columns(since, product_id)
+    
+    keys, inverse = np.unique(np.concatenate([rollups[:, 0], events[:, 0]]), return_inverse=True)
+    rollup_groups, groups = inverse[:len(rollups)], inverse[len(rollups):]
+    size = len(keys)
+    window_hours = days * 24
+    
+    # 件数与时段分布（每个商品 24 个小时桶）
+    sold_units = np.bincount(rollup_groups, weights=rollups[:, 2], minlength=size)
+    restock_units = np.bincount(rollup_groups, weights=rollups[:, 3], minlength=size)
+    changes = np.bincount(rollup_groups, weights=rollups[:, 4], minlength=size)
+    rollup_hours = (rollups[:, 1] % 86400) // SECONDS_PER_HOUR
+    hourly_sales = np.bincount(rollup_groups * 24 + rollup_hours, weights=rollups[:, 2],
+                               minlength=size * 24).reshape(size, 24)
+    
+    previous, current, seconds = events[:, 1], events[:, 2], events[:, 3]
+    restock = current > previous
+    restocks = np.bincount(groups, weights=restock, minlength=size)
+    hourly_restocks = np.bincount(groups * 24 + (seconds % 86400) // SECONDS_PER_HOUR, weights=restock,
+                                  minlength=size * 24).reshape(size, 24)
+    
+    # 售罄时长：每次补货之后同一商品第一次降为 0 的记录，且中间没有再次补货
+    restock_pos = np.flatnonzero(restock)
+    soldout_pos = np.flatnonzero((current == 0) & (previous > 0))
+    next_restock = np.append(restock_pos[1:], len(events))
+    if len(soldout_pos):
+        next_soldout = np.searchsorted(soldout_pos, restock_pos)
+        soldout_at = soldout_pos[np.minimum(next_soldout, len(soldout_pos) - 1)]
+        valid = (next_soldout < len(soldout_pos)) & (groups[soldout_at] == groups[restock_pos]) & (soldout_at < next_restock)
+    else:
+        soldout_at, valid = restock_pos, np.zeros(len(restock_pos), dtype=bool)
+    sellout_hours = (seconds[soldout_at[valid]] - seconds[restock_pos[valid]]) / SECONDS_PER_HOUR
+    avg_sellout, sellouts = group_mean(groups[restock_pos[valid]], sellout_hours, size)
+    
+    # 相邻两次补货的间隔（同一商品）
+    same_product = groups[restock_pos[1:]] == groups[restock_pos[:-1]]
+    intervals = (seconds[restock_pos[1:]] - seconds[restock_pos[:-1]])[same_product] / SECONDS_PER_HOUR
+    avg_interval, _ = group_mean(groups[restock_pos[1:]][same_product], intervals, size)
+    
+    def rounded(value, digits=2):
+        return None if np.isnan(value) else round(float(value), digits)
+    
+    names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(keys.tolist())).all()) if size else {}
+    products = [{
+        'product_id': int(key),
+        'product_name': names.get(int(key)),
+        'changes': int(changes[index]),
+        'sold_units': int(sold_units[index]),
+        'restock_units': int(restock_units[index]),
+        'restocks': int(restocks[index]),
+        'velocity_per_hour': round(float(sold_units[index]) / window_hours, 3),
+        'velocity_per_day': round(float(sold_units[index]) / days, 2),
+        'restocks_per_day': round(float(restocks[index]) / days, 3),
+        'avg_restock_interval_hours': rounded(avg_interval[index]),
+        'avg_sellout_hours': rounded(avg_sellout[index]),
+        'sellouts': int(sellouts[index]),
+        'peak_hour': int(hourly_sales[index].argmax()) if sold_units[index] else None
+    } for index, key in enumerate(keys)]
+    products.sort(key=lambda item: item['sold_units'], reverse=True)
+    
+    fleet_sales = hourly_sales.sum(axis=0)
+    return {
+        'days': days,
+        'since': since.isoformat(),
+        'fleet': {
+            'products': size,
+            'changes': int(changes.sum()),
+            'sold_units': int(sold_units.sum()),
+            'restock_units': int(restock_units.sum()),
+            'restocks': int(len(restock_pos)),
+            'velocity_per_hour': round(float(sold_units.sum()) / window_hours, 3),
+            'median_sellout_hours': rounded(np.median(sellout_hours)) if len(sellout_hours) else None,
+            'median_restock_interval_hours': rounded(np.median(intervals)) if len(intervals) else None,
+            'peak_hour': int(fleet_sales.argmax()) if fleet_sales.any() else None,
+            'hourly_sales': fleet_sales.astype(int).tolist(),
+            'hourly_restocks': hourly_restocks.sum(axis=0).astype(int).tolist()
+        },
+        'products': products
+    }
+
+@app.route('/api/analytics')
+@login_required
+def api_analytics():
+    """API: 库存分析（销售速度、售罄时长、补货频率、时段分布），参数: days, product_id"""
+    # 统计范围是"截至现在的最近 N 天"，校验值包含当前小时，没有新事件时结果也会随时间窗口更新
+    window = get_internet_time().strftime('%Y-%m-%d %H')
+    return etag_response((data_versions.get('events'), data_versions.get('products'), data_versions.get('config'),
+                          window, request.query_string), build_analytics_response)
+
+def build_analytics_response():
+    try:
+        days = request.args.get('days', DEFAULT_ANALYTICS_DAYS, type=float)
+        if not days or days <= 0:
+            days = DEFAULT_ANALYTICS_DAYS
+        days = min(days, MAX_ANALYTICS_DAYS)
+        # 补货次数与售罄时长读取原始库存历史，超过保留天数的记录已被清理，时间范围不能超过保留天数
+        history_days, _ = get_retention_days(NotificationConfig.query.first())
+        if history_days:
+            days = min(days, float(history_days))
+        analytics = compute_stock_analytics(days, request.args.get('product_id', type=int))
+        return jsonify({'success': True, **analytics})
+    except Exception as e:
+        logger.error(f"计算库存分析失败: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
@@ -1208,6 +3366,14 @@ def settings():
         db.session.commit()
     
     if request.method == 'POST':
+        # 先校验通知模板，模板有误时不保存任何设置
+        for notification_type, label in (('restock', '补货通知模板'), ('sale', '销售通知模板')):
+            try:
+                compile_template(request.form.get(f'template_{notification_type}') or DEFAULT_NOTIFICATION_TEMPLATES[notification_type])
+            except TemplateError as e:
+                flash(f'{label}无效: {e}', 'error')
+                return redirect(url_for('settings'))
+        
         config.telegram_bot_token = request.form['telegram_bot_token']
         
         config.channel_enabled = 'channel_enabled' in request.form
@@ -1234,6 +3400,45 @@ def settings():
         except:
             config.check_interval = 120
         
+        # 并发检测数量
+        try:
+            concurrency = int(request.form.get('fetch_concurrency', DEFAULT_FETCH_CONCURRENCY))
+            config.fetch_concurrency = max(1, min(concurrency, MAX_FETCH_CONCURRENCY))
+        except:
+            config.fetch_concurrency = DEFAULT_FETCH_CONCURRENCY
+        
+        # 站点礼貌访问设置
+        try:
+            per_host_concurrency = int(request.form.get('per_host_concurrency', DEFAULT_PER_HOST_CONCURRENCY))
+            config.per_host_concurrency = max(1, min(per_host_concurrency, MAX_PER_HOST_CONCURRENCY))
+        except:
+            config.per_host_concurrency = DEFAULT_PER_HOST_CONCURRENCY
+        try:
+            per_host_interval = float(request.form.get('per_host_interval', DEFAULT_PER_HOST_INTERVAL))
+            config.per_host_interval = max(0.0, min(per_host_interval, MAX_PER_HOST_INTERVAL))
+        except:
+            config.per_host_interval = DEFAULT_PER_HOST_INTERVAL
+        
+        # 日志保留天数
+        try:
+            history_days = int(request.form.get('history_retention_days', DEFAULT_HISTORY_RETENTION_DAYS))
+            config.history_retention_days = max(0, min(history_days, MAX_RETENTION_DAYS))
+        except:
+            config.history_retention_days = DEFAULT_HISTORY_RETENTION_DAYS
+        try:
+            notification_days = int(request.form.get('notification_retention_days', DEFAULT_NOTIFICATION_RETENTION_DAYS))
+            config.notification_retention_days = max(0, min(notification_days, MAX_RETENTION_DAYS))
+        except:
+            config.notification_retention_days = DEFAULT_NOTIFICATION_RETENTION_DAYS
+        
+        # 汇总通知
+        config.digest_enabled = 'digest_enabled' in request.form
+        try:
+            digest_window = int(request.form.get('digest_window', DEFAULT_DIGEST_WINDOW))
+            config.digest_window = max(1, min(digest_window, MAX_DIGEST_WINDOW))
+        except:
+            config.digest_window = DEFAULT_DIGEST_WINDOW
+        
         # 通知类型开关（向后兼容）
         if hasattr(config, 'restock_enabled'):
             config.restock_enabled = 'restock_enabled' in request.form
@@ -1249,6 +3454,7 @@ def settings():
         config.updated_at = get_internet_time().replace(tzinfo=None)
         
         db.session.commit()
+        dashboard_stats.set_config(config)
         
         # 更新调度器间隔
         update_scheduler_v2()
@@ -1258,78 +3464,161 @@ def settings():
     
     return render_template('settings.html', config=config)
 
+# 备份导入导出
+EXPORT_VERSION = '3.0'
+EXPORT_HISTORY_LIMIT = 1000       # 导出最近的库存历史条数
+EXPORT_FLUSH_BYTES = 64 * 1024    # 流式导出每次输出的数据量
+IMPORT_BATCH_SIZE = 500           # 导入时每批写入的商品数量
+
+# 备份中的商品字段 -> 缺省值
+PRODUCT_IMPORT_FIELDS = {
+    'current_stock': 0,
+    'last_stock': 0,
+    'threshold': 1,
+    'is_active': True,
+    'needs_full_document': False,
+    'min_interval': None,
+    'max_interval': None,
+}
+
+# 备份中的通知配置字段 -> 缺省值
+CONFIG_IMPORT_FIELDS = {
+    'channel_enabled': False,
+    'channel_id': '',
+    'group_enabled': False,
+    'group_id': '',
+    'personal_enabled': False,
+    'personal_chat_id': '',
+    'user_enabled': False,
+    'user_id': '',
+    'check_interval': 120,
+    'fetch_concurrency': DEFAULT_FETCH_CONCURRENCY,
+    'per_host_concurrency': DEFAULT_PER_HOST_CONCURRENCY,
+    'per_host_interval': DEFAULT_PER_HOST_INTERVAL,
+    'history_retention_days': DEFAULT_HISTORY_RETENTION_DAYS,
+    'notification_retention_days': DEFAULT_NOTIFICATION_RETENTION_DAYS,
+    'digest_enabled': False,
+    'digest_window': DEFAULT_DIGEST_WINDOW,
+    'restock_enabled': True,
+    'sale_enabled': True,
+}
+
+def serialize_product_backup(p):
+    """商品 -> 备份记录"""
+    return {
+        'name': p.name,
+        'url': p.url,
+        'target_selector': p.target_selector,
+        'current_stock': p.current_stock,
+        'last_stock': p.last_stock,
+        'threshold': p.threshold,
+        'is_active': p.is_active,
+        'buy_url': p.buy_url,
+        'needs_full_document': bool(p.needs_full_document),
+        'min_interval': p.min_interval,
+        'max_interval': p.max_interval,
+        'created_at': p.created_at.isoformat() if p.created_at else None,
+        'updated_at': p.updated_at.isoformat() if p.updated_at else None
+    }
+
+def serialize_config_backup(config):
+    """通知配置 -> 备份记录"""
+    if not config:
+        return None
+    data = {'telegram_bot_token': config.telegram_bot_token}
+    data.update({field: getattr(config, field, default) for field, default in CONFIG_IMPORT_FIELDS.items()})
+    data['template_restock'] = getattr(config, 'template_restock', '')
+    data['template_sale'] = getattr(config, 'template_sale', '')
+    return data
+
+def iter_backup_records():
+    """按顺序生成备份记录 (类型, 数据)：导出信息、通知配置、商品、库存历史"""
+    yield 'export_info', {
+        'export_time': get_internet_time().isoformat(),
+        'version': EXPORT_VERSION,
+        'app_name': 'EDUKY-商品监控系统'
+    }
+    with app.app_context():
+        yield 'notification_config', serialize_config_backup(NotificationConfig.query.first())
+        
+        names = {}
+        for p in Product.query.order_by(Product.id).yield_per(IMPORT_BATCH_SIZE):
+            names[p.id] = p.name
+            yield 'product', serialize_product_backup(p)
+        
+        histories = db.session.query(StockHistory.product_id, StockHistory.stock_count,
+                                     StockHistory.timestamp, StockHistory.change_type)\
+            .order_by(StockHistory.timestamp.desc()).limit(EXPORT_HISTORY_LIMIT)
+        for h in histories:
+            yield 'stock_history', {
+                'product_name': names.get(h.product_id, 'Unknown'),
+                'stock_count': h.stock_count,
+                'timestamp': h.timestamp.isoformat() if h.timestamp else None,
+                'change_type': h.change_type
+            }
+
+def generate_ndjson_export(compress=False):
+    """流式生成 NDJSON 备份（每行一条记录），compress=True 时输出 gzip"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    size = 0
+    try:
+        for record_type, data in iter_backup_records():
+            line = json.dumps({'type': record_type, 'data': data}, ensure_ascii=False) + '\n'
+            buffer.append(line)
+            size += len(line)
+            if size >= EXPORT_FLUSH_BYTES:
+                chunk = ''.join(buffer).encode('utf-8')
+                buffer, size = [], 0
+                chunk = compressor.compress(chunk) if compressor else chunk
+                if chunk:
+                    yield chunk
+        chunk = ''.join(buffer).encode('utf-8')
+        yield compressor.compress(chunk) + compressor.flush() if compressor else chunk
+    except Exception as e:
+        # 响应已开始发送，只能记录错误并中断下载
+        logger.error(f"数据导出失败: {e}")
+        raise
+
 @app.route('/api/export_data', methods=['GET'])
 @login_required
 def export_data():
-    """导出所有数据"""
+    """导出所有数据
+    
+    默认流式输出 NDJSON 备份文件，gzip=1 时压缩；format=json 时返回旧版的完整 JSON 文档
+    """
     try:
-        with app.app_context():
-            # 导出商品数据
-            products = Product.query.all()
+        if request.args.get('format') == 'json':
             products_data = []
-            for p in products:
-                products_data.append({
-                    'name': p.name,
-                    'url': p.url,
-                    'target_selector': p.target_selector,
-                    'current_stock': p.current_stock,
-                    'last_stock': p.last_stock,
-                    'threshold': p.threshold,
-                    'is_active': p.is_active,
-                    'buy_url': p.buy_url,
-                    'created_at': p.created_at.isoformat() if p.created_at else None,
-                    'updated_at': p.updated_at.isoformat() if p.updated_at else None
-                })
-            
-            # 导出通知配置数据
-            config = NotificationConfig.query.first()
             config_data = None
-            if config:
-                config_data = {
-                    'telegram_bot_token': config.telegram_bot_token,
-                    'channel_enabled': config.channel_enabled,
-                    'channel_id': config.channel_id,
-                    'group_enabled': config.group_enabled,
-                    'group_id': config.group_id,
-                    'personal_enabled': config.personal_enabled,
-                    'personal_chat_id': config.personal_chat_id,
-                    'user_enabled': getattr(config, 'user_enabled', False),
-                    'user_id': getattr(config, 'user_id', ''),
-                    'check_interval': config.check_interval,
-                    'restock_enabled': getattr(config, 'restock_enabled', True),
-                    'sale_enabled': getattr(config, 'sale_enabled', True),
-                    'template_restock': getattr(config, 'template_restock', ''),
-                    'template_sale': getattr(config, 'template_sale', '')
-                }
-            
-            # 导出库存历史数据（最近1000条）
-            histories = StockHistory.query.order_by(StockHistory.timestamp.desc()).limit(1000).all()
             histories_data = []
-            for h in histories:
-                histories_data.append({
-                    'product_name': h.product.name if h.product else 'Unknown',
-                    'stock_count': h.stock_count,
-                    'timestamp': h.timestamp.isoformat() if h.timestamp else None,
-                    'change_type': h.change_type
-                })
-            
-            # 组装导出数据
-            export_data = {
-                'export_info': {
-                    'export_time': get_internet_time().isoformat(),
-                    'version': '2.0',
-                    'app_name': 'EDUKY-商品监控系统'
-                },
-                'products': products_data,
-                'notification_config': config_data,
-                'stock_histories': histories_data
-            }
+            for record_type, data in iter_backup_records():
+                if record_type == 'export_info':
+                    export_info = data
+                elif record_type == 'notification_config':
+                    config_data = data
+                elif record_type == 'product':
+                    products_data.append(data)
+                else:
+                    histories_data.append(data)
             
             return jsonify({
                 'success': True,
-                'data': export_data,
+                'data': {
+                    'export_info': export_info,
+                    'products': products_data,
+                    'notification_config': config_data,
+                    'stock_histories': histories_data
+                },
                 'message': f'成功导出 {len(products_data)} 个商品和相关配置'
             })
+        
+        compress = request.args.get('gzip') in ('1', 'true')
+        timestamp = get_internet_time().strftime('%Y%m%d_%H%M')
+        filename = f"inventory_backup_{timestamp}.ndjson" + ('.gz' if compress else '')
+        return Response(generate_ndjson_export(compress),
+                        mimetype='application/gzip' if compress else 'application/x-ndjson',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
             
     except Exception as e:
         logger.error(f"数据导出失败: {e}")
@@ -1338,10 +3627,96 @@ def export_data():
             'message': f'导出失败: {str(e)}'
         }), 500
 
+class BackupFormatError(ValueError):
+    """备份文件格式不正确"""
+
+def iter_import_records(file):
+    """逐条读取上传的备份文件，返回 (类型, 数据)
+    
+    支持 NDJSON（.ndjson / .jsonl，可 gzip 压缩）逐行解析；旧版 .json 备份整体解析后按相同顺序输出。
+    """
+    stream = file.stream
+    filename = file.filename.lower()
+    if stream.read(2) == b'\x1f\x8b':
+        stream.seek(0)
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        filename = filename[:-3] if filename.endswith('.gz') else filename
+    else:
+        stream.seek(0)
+    reader = io.TextIOWrapper(stream, encoding='utf-8')
+    
+    if filename.endswith('.json'):
+        try:
+            document = json.load(reader)
+        except json.JSONDecodeError:
+            raise BackupFormatError('备份文件格式错误，请检查JSON格式')
+        if not isinstance(document, dict) or 'products' not in document or 'notification_config' not in document:
+            raise BackupFormatError('备份文件格式不正确')
+        yield 'export_info', document.get('export_info') or {}
+        yield 'notification_config', document.get('notification_config')
+        for product_data in document.get('products') or []:
+            yield 'product', product_data
+        return
+    
+    for line_number, line in enumerate(reader, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            raise BackupFormatError(f'备份文件第 {line_number} 行不是有效的JSON')
+        if not isinstance(record, dict) or 'type' not in record:
+            raise BackupFormatError(f'备份文件第 {line_number} 行缺少记录类型')
+        if line_number == 1 and record['type'] != 'export_info':
+            raise BackupFormatError('备份文件格式不正确')
+        yield record['type'], record.get('data')
+
+def import_product_batch(batch, existing_names):
+    """写入一批商品（跳过已存在的同名商品），每批单独提交，返回写入数量"""
+    rows = []
+    for product_data in batch:
+        name = product_data.get('name')
+        if not name or name in existing_names or not product_data.get('url') or not product_data.get('target_selector'):
+            continue
+        existing_names.add(name)
+        row = {field: product_data.get(field, default) for field, default in PRODUCT_IMPORT_FIELDS.items()}
+        row.update(name=name, url=product_data['url'], target_selector=product_data['target_selector'],
+                   buy_url=product_data.get('buy_url', product_data['url']))
+        rows.append(row)
+    if rows:
+        db.session.execute(db.insert(Product), rows)
+        db.session.commit()
+    return len(rows)
+
+def apply_config_backup(config_data):
+    """导入通知配置（创建或更新）"""
+    config = NotificationConfig.query.first()
+    if not config:
+        config = NotificationConfig()
+        db.session.add(config)
+        config.telegram_bot_token = config_data.get('telegram_bot_token', '')
+        config.template_restock = config_data.get('template_restock', '')
+        config.template_sale = config_data.get('template_sale', '')
+    else:
+        config.telegram_bot_token = config_data.get('telegram_bot_token', config.telegram_bot_token or '')
+        config.template_restock = config_data.get('template_restock', config.template_restock or '')
+        config.template_sale = config_data.get('template_sale', config.template_sale or '')
+        config.updated_at = get_internet_time().replace(tzinfo=None)
+    for field, default in CONFIG_IMPORT_FIELDS.items():
+        setattr(config, field, config_data.get(field, default))
+    db.session.commit()
+
 @app.route('/api/import_data', methods=['POST'])
 @login_required
 def import_data():
-    """导入数据"""
+    """导入数据
+    
+    逐条解析备份文件；已有商品名称一次性读入集合，新商品按批批量写入，每批单独提交，
+    监控任务只需等待单批写入。
+    """
+    imported_count = 0
+    config_imported = False
     try:
         if 'backup_file' not in request.files:
             return jsonify({
@@ -1356,112 +3731,54 @@ def import_data():
                 'message': '请选择备份文件'
             }), 400
             
-        if not file.filename.endswith('.json'):
+        if not file.filename.lower().endswith(('.json', '.ndjson', '.jsonl', '.gz')):
             return jsonify({
                 'success': False,
-                'message': '请选择JSON格式的备份文件'
+                'message': '请选择 JSON / NDJSON 格式的备份文件'
             }), 400
         
-        # 读取并解析文件
-        file_content = file.read().decode('utf-8')
-        import_data = json.loads(file_content)
+        try:
+            with app.app_context():
+                existing_names = {name for (name,) in db.session.query(Product.name)}
+                batch = []
+                for record_type, data in iter_import_records(file):
+                    if record_type == 'product' and isinstance(data, dict):
+                        batch.append(data)
+                        if len(batch) >= IMPORT_BATCH_SIZE:
+                            imported_count += import_product_batch(batch, existing_names)
+                            batch = []
+                    elif record_type == 'notification_config' and data:
+                        apply_config_backup(data)
+                        config_imported = True
+                imported_count += import_product_batch(batch, existing_names)
+        finally:
+            # 部分批次已提交时也同步统计
+            if imported_count or config_imported:
+                dashboard_stats.rebuild()
         
-        # 验证数据格式
-        if 'products' not in import_data or 'notification_config' not in import_data:
-            return jsonify({
-                'success': False,
-                'message': '备份文件格式不正确'
-            }), 400
+        # 构建导入结果消息
+        message_parts = []
+        if imported_count > 0:
+            message_parts.append(f'{imported_count} 个商品')
+        if config_imported:
+            message_parts.append('系统配置')
         
-        with db_lock:
-            with app.app_context():
-                imported_count = 0
-                
-                # 导入商品数据
-                if import_data.get('products'):
-                    for product_data in import_data['products']:
-                        # 检查是否已存在同名商品
-                        existing = Product.query.filter_by(name=product_data['name']).first()
-                        if not existing:
-                            product = Product(
-                                name=product_data['name'],
-                                url=product_data['url'],
-                                target_selector=product_data['target_selector'],
-                                current_stock=product_data.get('current_stock', 0),
-                                last_stock=product_data.get('last_stock', 0),
-                                threshold=product_data.get('threshold', 1),
-                                is_active=product_data.get('is_active', True),
-                                buy_url=product_data.get('buy_url', product_data['url'])
-                            )
-                            db.session.add(product)
-                            imported_count += 1
-                
-                # 导入通知配置（创建或更新）
-                if import_data.get('notification_config'):
-                    config_data = import_data['notification_config']
-                    config = NotificationConfig.query.first()
-                    
-                    if not config:
-                        # 创建新配置
-                        config = NotificationConfig(
-                            telegram_bot_token=config_data.get('telegram_bot_token', ''),
-                            channel_enabled=config_data.get('channel_enabled', False),
-                            channel_id=config_data.get('channel_id', ''),
-                            group_enabled=config_data.get('group_enabled', False),
-                            group_id=config_data.get('group_id', ''),
-                            personal_enabled=config_data.get('personal_enabled', False),
-                            personal_chat_id=config_data.get('personal_chat_id', ''),
-                            user_enabled=config_data.get('user_enabled', False),
-                            user_id=config_data.get('user_id', ''),
-                            check_interval=config_data.get('check_interval', 120),
-                            restock_enabled=config_data.get('restock_enabled', True),
-                            sale_enabled=config_data.get('sale_enabled', True),
-                            template_restock=config_data.get('template_restock', ''),
-                            template_sale=config_data.get('template_sale', '')
-                        )
-                        db.session.add(config)
-                    else:
-                        # 更新现有配置
-                        config.telegram_bot_token = config_data.get('telegram_bot_token', config.telegram_bot_token or '')
-                        config.channel_enabled = config_data.get('channel_enabled', False)
-                        config.channel_id = config_data.get('channel_id', '')
-                        config.group_enabled = config_data.get('group_enabled', False)
-                        config.group_id = config_data.get('group_id', '')
-                        config.personal_enabled = config_data.get('personal_enabled', False)
-                        config.personal_chat_id = config_data.get('personal_chat_id', '')
-                        config.user_enabled = config_data.get('user_enabled', False)
-                        config.user_id = config_data.get('user_id', '')
-                        config.check_interval = config_data.get('check_interval', 120)
-                        config.restock_enabled = config_data.get('restock_enabled', True)
-                        config.sale_enabled = config_data.get('sale_enabled', True)
-                        config.template_restock = config_data.get('template_restock', config.template_restock or '')
-                        config.template_sale = config_data.get('template_sale', config.template_sale or '')
-                        config.updated_at = get_internet_time().replace(tzinfo=None)
-                
-                # 提交数据库更改
-                db.session.commit()
-                
-                # 构建导入结果消息
-                config_imported = bool(import_data.get('notification_config'))
-                message_parts = []
-                if imported_count > 0:
-                    message_parts.append(f'{imported_count} 个商品')
-                if config_imported:
-                    message_parts.append('系统配置')
-                
-                message = f'成功导入 {" 和 ".join(message_parts)}' if message_parts else '没有新数据需要导入'
-                
-                return jsonify({
-                    'success': True,
-                    'message': message,
-                    'imported_products': imported_count,
-                    'imported_config': config_imported
-                })
-                
-    except json.JSONDecodeError:
+        message = f'成功导入 {" 和 ".join(message_parts)}' if message_parts else '没有新数据需要导入'
+        
+        return jsonify({
+            'success': True,
+            'message': message,
+            'imported_products': imported_count,
+            'imported_config': config_imported
+        })
+            
+    except (BackupFormatError, UnicodeDecodeError, OSError, EOFError) as e:
+        message = str(e) if isinstance(e, BackupFormatError) else '备份文件无法读取，请检查文件是否完整'
+        if imported_count:
+            message += f'（已导入 {imported_count} 个商品）'
         return jsonify({
             'success': False,
-            'message': '备份文件格式错误，请检查JSON格式'
+            'message': message
         }), 400
     except Exception as e:
         try:
@@ -1478,7 +3795,12 @@ def import_data():
 @login_required
 def api_products():
     """API: 获取所有商品"""
+    validator = (data_versions.get('products'), data_versions.get('config'), adaptive_scheduler.revision)
+    return etag_response(validator, build_products_response)
+
+def build_products_response():
     products = Product.query.all()
+    default_interval = get_default_interval(NotificationConfig.query.first())
     return jsonify([{
         'id': p.id,
         'name': p.name,
@@ -1487,58 +3809,98 @@ def api_products():
         'threshold': p.threshold,
         'is_active': p.is_active,
         'updated_at': db_time_to_china_time(p.updated_at).isoformat() if p.updated_at else None,
-        'version': p.version
+        'version': p.version,
+        'effective_interval': adaptive_scheduler.get_interval(p, default_interval)
     } for p in products])
 
+def etag_response(validator, build):
+    """根据数据版本生成 ETag；与请求的 If-None-Match 相同时直接返回 304，不再生成响应内容"""
+    etag = hashlib.sha1(f"{data_versions.boot_id}:{validator}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            # 错误响应不带 ETag，避免被当作最新数据缓存
+            return response
+    response.set_etag(etag)
+    # 浏览器每次都需向服务端确认
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/api/system_status')
 @login_required
 def api_system_status():
-    """API: 获取系统状态"""
-    with app.app_context():
-        total_products = Product.query.count()
-        active_products = Product.query.filter_by(is_active=True).count()
-        in_stock_products = Product.query.filter(Product.current_stock > 0).count()
-        out_stock_products = Product.query.filter(Product.current_stock == 0).count()
-        
-        # 获取最近的监控时间
-        latest_update = db.session.query(db.func.max(Product.updated_at)).scalar()
-        
-        config = NotificationConfig.query.first()
-        
-        # 获取当前互联网时间
-        current_internet_time = get_internet_time()
-        
+    """API: 获取系统状态（读取内存中的统计，不访问数据库）
+    
+    ETag 不包含当前时间，页面根据上次返回的服务器时间自行推算
+    """
+    dashboard_stats.snapshot()  # 首次访问时加载统计，确保版本号已初始化
+    validator = (data_versions.get('products'), data_versions.get('config'),
+                 last_round_stats.get('finished_at'), len(monitor.hosts.stats()), notification_dispatcher.revision())
+    return etag_response(validator, build_system_status_response)
+
+def build_system_status_response():
+    counts, config_summary, latest_update = dashboard_stats.snapshot()
+    
+    # 页面未变化的商品不写库，以最近一轮结束时间为准
+    if last_round_stats.get('finished_at'):
+        round_finished = datetime.fromisoformat(last_round_stats['finished_at']).replace(tzinfo=None)
+        if latest_update is None or round_finished > latest_update:
+            latest_update = round_finished
+    
+    # 当前时间（来自后台同步的时钟服务）
+    current_internet_time = get_internet_time()
+    
+    return jsonify({
+        'total_products': counts['total'],
+        'active_products': counts['active'],
+        'in_stock_products': counts['in_stock'],
+        'out_stock_products': counts['out_stock'],
+        'latest_update': db_time_to_china_time(latest_update).isoformat() if latest_update else None,
+        'latest_update_formatted': db_time_to_china_time(latest_update).strftime('%Y-%m-%d %H:%M:%S') if latest_update else '从未检查',
+        'current_time': current_internet_time.isoformat(),
+        'current_time_formatted': current_internet_time.strftime('%Y-%m-%d %H:%M:%S'),
+        **config_summary,
+        'monitored_hosts': len(monitor.hosts.stats()),
+        'last_round': last_round_stats or None,
+        'notifications': notification_dispatcher.status()
+    })
+
+@app.route('/api/notification_queue')
+@login_required
+def api_notification_queue():
+    """API: 通知发送队列、发件箱状态与各聊天的请求耗时"""
+    try:
         return jsonify({
-            'total_products': total_products,
-            'active_products': active_products,
-            'in_stock_products': in_stock_products,
-            'out_stock_products': out_stock_products,
-            'latest_update': db_time_to_china_time(latest_update).isoformat() if latest_update else None,
-            'latest_update_formatted': db_time_to_china_time(latest_update).strftime('%Y-%m-%d %H:%M:%S') if latest_update else '从未检查',
-            'current_time': current_internet_time.isoformat(),
-            'current_time_formatted': current_internet_time.strftime('%Y-%m-%d %H:%M:%S'),
-            'bot_configured': bool(config and config.telegram_bot_token),
-            'notification_channels': sum([
-                bool(config.channel_enabled) if config else False,
-                bool(config.group_enabled) if config else False,
-                bool(config.personal_enabled) if config else False,
-                bool(getattr(config, 'user_enabled', False)) if config else False
-            ]) if config else 0,
-            'check_interval': config.check_interval if config and config.check_interval else 120
+            'success': True,
+            'dispatcher': notification_dispatcher.status(),
+            'outbox': outbox.status(),
+            'chats': telegram.stats()
         })
+    except Exception as e:
+        logger.error(f"获取通知队列状态失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
 
 @app.route('/api/sync_time', methods=['POST'])
 @login_required
 def api_sync_time():
-    """API: 同步互联网时间"""
+    """API: 同步互联网时间（synced_now 为本次同步是否成功，sync_status 中的 synced 表示是否曾经同步过）"""
     try:
+        synced_now = clock.sync()
         internet_time = get_internet_time()
         return jsonify({
             'success': True,
+            'synced_now': synced_now,
+            'sync_error': None if synced_now else clock.last_error,
             'current_time': internet_time.isoformat(),
             'formatted_time': internet_time.strftime('%Y-%m-%d %H:%M:%S'),
             'timezone': 'Asia/Shanghai',
-            'timestamp': internet_time.timestamp()
+            'timestamp': internet_time.timestamp(),
+            'sync_status': clock.status()
         })
     except Exception as e:
         logger.error(f"时间同步失败: {e}")
@@ -1554,25 +3916,41 @@ def api_test_monitor(product_id):
     try:
         product = Product.query.get_or_404(product_id)
         
-        # 检查库存
-        new_stock = monitor.check_stock(product)
-        
-        if new_stock is not None:
-            # 更新库存
-            stock_changed, old_stock, updated_stock = monitor.update_stock_safe(product_id, new_stock)
-            
-            return jsonify({
-                'success': True,
-                'stock': updated_stock,
-                'old_stock': old_stock,
-                'changed': stock_changed,
-                'message': f'库存检测成功，当前库存: {updated_stock}'
-            })
-        else:
+        # 同一商品不能同时被两个检测任务处理
+        if not adaptive_scheduler.try_claim(product_id):
             return jsonify({
                 'success': False,
-                'message': '无法获取库存信息，请检查网址和CSS选择器'
+                'message': '该商品正在检测中，请稍后再试'
             })
+        
+        try:
+            # 检查库存（检测期间商品被编辑则不写入）
+            version = product.version
+            new_stock = monitor.check_stock(product)
+            
+            if new_stock is not None:
+                # 更新库存
+                stock_changed, old_stock, updated_stock = monitor.update_stock_safe(product_id, new_stock, version=version)
+                if updated_stock is None:
+                    return jsonify({
+                        'success': False,
+                        'message': '检测期间商品已被修改，请重新检测'
+                    })
+            else:
+                return jsonify({
+                    'success': False,
+                    'message': '无法获取库存信息，请检查网址和CSS选择器'
+                })
+        finally:
+            adaptive_scheduler.release(product_id)
+        
+        return jsonify({
+            'success': True,
+            'stock': updated_stock,
+            'old_stock': old_stock,
+            'changed': stock_changed,
+            'message': f'库存检测成功，当前库存: {updated_stock}'
+        })
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1584,9 +3962,15 @@ def api_test_monitor(product_id):
 def api_manual_check():
     """手动触发检查所有商品"""
     try:
+        if round_lock.locked():
+            return jsonify({
+                'success': False,
+                'message': '已有监控正在进行，请稍后再试'
+            })
+        
         # 在后台线程中运行监控
         def run_monitor():
-            monitor_all_products_v2()
+            monitor_all_products_v2(force=True)
         
         import threading
         monitor_thread = threading.Thread(target=run_monitor)
@@ -1607,6 +3991,9 @@ def api_manual_check():
 @login_required
 def api_recent_notifications():
     """API: 获取最近的通知"""
+    return etag_response((data_versions.get('events'), data_versions.get('products')), build_recent_notifications_response)
+
+def build_recent_notifications_response():
     notifications = NotificationLog.query\
         .order_by(NotificationLog.timestamp.desc())\
         .limit(50).all()
@@ -1626,97 +4013,108 @@ def logs_page():
     """日志页面"""
     return render_template('logs.html')
 
+# 监控日志分页
+LOG_PAGE_SIZE = 100
+MAX_LOG_PAGE_SIZE = 500
+# 日志来源 -> 事件类型（兼容旧的来源名称）
+LOG_SOURCES = {'inventory_change': 'stock_change', 'notification': 'notification'}
+# 事件类型 -> 日志ID前缀
+EVENT_ID_PREFIX = {'stock_change': 'stock', 'notification': 'notification'}
+
+def serialize_event(row):
+    """事件记录 -> 日志接口与实时推送使用的字典"""
+    return {
+        'id': f"{EVENT_ID_PREFIX.get(row.event_type, row.event_type)}_{row.id}",
+        'product_id': row.product_id,
+        'product_name': row.product_name,
+        'level': row.level,
+        'message': row.message,
+        'details': row.details,
+        'timestamp': db_time_to_china_time(row.timestamp).isoformat() if row.timestamp else None
+    }
+
+def parse_log_time(value, end_of_day=False):
+    """解析日志时间过滤参数（日期或 ISO 时间），返回数据库中使用的无时区中国时间"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'无效的时间: {value}')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(CHINA_TZ).replace(tzinfo=None)
+    if end_of_day and len(value) == 10:
+        # 只给出日期的截止时间包含当天
+        parsed += timedelta(days=1)
+    return parsed
+
 @app.route('/api/monitoring_logs')
 @login_required
 def api_monitoring_logs():
-    """API: 获取监控日志"""
+    """API: 获取监控日志（按事件序号倒序分页）
+    
+    参数: limit, cursor（上一页返回的 next_cursor）, after（只返回比该序号新的日志，取 head_cursor，
+    has_more 时继续用新的 head_cursor 读取）, product_id, level, source (inventory_change / notification 或事件类型),
+    since, until（日期或 ISO 时间，until 不包含）
+    """
+    return etag_response((data_versions.get('events'), request.query_string), build_monitoring_logs_response)
+
+def build_monitoring_logs_response():
     try:
-        logs = []
-        
-        # 获取库存变化历史记录
-        history_logs = db.session.query(StockHistory, Product)\
-            .join(Product, StockHistory.product_id == Product.id)\
-            .order_by(StockHistory.timestamp.desc())\
-            .limit(1000).all()
-            
-        for history, product in history_logs:
-            # 确定日志级别和消息，基于变化类型
-            stock_difference = history.stock_count - history.previous_stock
-            if history.change_type == 'increase':
-                level = 'success'
-                message = f'库存补货: +{stock_difference} 件'
-            elif history.change_type == 'decrease':
-                level = 'warning'
-                message = f'库存减少: -{abs(stock_difference)} 件'
-            else:
-                # 这种情况现在不应该出现，因为我们只在有变化时记录
-                level = 'info'
-                message = f'库存变化: {stock_difference:+d} 件'
-                
-            logs.append({
-                'id': f'stock_{history.id}',
-                'product_id': product.id,
-                'product_name': product.name,
-                'level': level,
-                'message': message,
-                'details': f'变化时间: {db_time_to_china_time(history.timestamp).strftime("%Y-%m-%d %H:%M:%S")} | 库存变化: {history.previous_stock} → {history.stock_count} | 变化类型: {history.change_type}',
-                'timestamp': db_time_to_china_time(history.timestamp).isoformat(),
-                'stock_count': history.stock_count,
-                'previous_stock': history.previous_stock,
-                'change_type': history.change_type,
-                'source': 'inventory_change'
-            })
+        limit = max(1, min(request.args.get('limit', LOG_PAGE_SIZE, type=int), MAX_LOG_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        after = request.args.get('after')
+        if cursor and not cursor.isdigit() or after and not after.isdigit():
+            raise ValueError('无效的分页游标')
+        if cursor and after:
+            raise ValueError('cursor 与 after 不能同时使用')
+        product_id = request.args.get('product_id', type=int)
+        level = request.args.get('level')
+        source = request.args.get('source')
+        since = parse_log_time(request.args.get('since'))
+        until = parse_log_time(request.args.get('until'), end_of_day=True)
         
-        # 获取通知日志记录
-        notification_logs = db.session.query(NotificationLog, Product)\
-            .join(Product, NotificationLog.product_id == Product.id)\
-            .order_by(NotificationLog.timestamp.desc())\
-            .limit(1000).all()
-            
-        for notif, product in notification_logs:
-            # 确定日志级别
-            if notif.status == 'sent':
-                level = 'success'
-                message = f'{notif.notification_type} 通知发送成功'
-            elif notif.status == 'failed':
-                level = 'error'
-                message = f'{notif.notification_type} 通知发送失败'
-            elif notif.status == 'error':
-                level = 'error'
-                message = f'{notif.notification_type} 通知发送出错'
-            else:
-                level = 'info'
-                message = f'{notif.notification_type} 通知状态: {notif.status}'
-                
-            details = f'发送时间: {db_time_to_china_time(notif.timestamp).strftime("%Y-%m-%d %H:%M:%S")}'
-            if notif.message:
-                details += f' | 消息: {notif.message}'
-                
-            logs.append({
-                'id': f'notification_{notif.id}',
-                'product_id': product.id,
-                'product_name': product.name,
-                'level': level,
-                'message': message,
-                'details': details,
-                'timestamp': db_time_to_china_time(notif.timestamp).isoformat(),
-                'notification_type': notif.notification_type,
-                'notification_status': notif.status,
-                'source': 'notification'
-            })
+        query = db.session.query(Event.id, Event.event_type, Event.product_id, Event.product_name,
+                                 Event.level, Event.message, Event.details, Event.timestamp)
+        if cursor:
+            query = query.filter(Event.id < int(cursor))
+        if after:
+            query = query.filter(Event.id > int(after))
+        if product_id:
+            query = query.filter(Event.product_id == product_id)
+        if level:
+            query = query.filter(Event.level == level)
+        if source:
+            query = query.filter(Event.event_type == LOG_SOURCES.get(source, source))
+        if since:
+            query = query.filter(Event.timestamp >= since)
+        if until:
+            query = query.filter(Event.timestamp < until)
         
-        # 按时间倒序排列所有日志
-        logs.sort(key=lambda x: x['timestamp'], reverse=True)
+        # 多取一条判断是否还有下一页；读取新日志时从 after 往后读，返回时仍按新到旧排列
+        order = Event.id.asc() if after else Event.id.desc()
+        rows = query.order_by(order).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after:
+            rows.reverse()
         
-        # 限制返回的日志数量
-        logs = logs[:2000]
+        logs = [serialize_event(row) for row in rows]
         
         return jsonify({
             'success': True,
             'logs': logs,
-            'total': len(logs)
+            'total': len(logs),
+            'has_more': has_more,
+            'next_cursor': str(rows[-1].id) if has_more and not after else None,
+            'head_cursor': str(rows[0].id) if rows else after
         })
         
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     except Exception as e:
         logger.error(f"获取监控日志失败: {e}")
         return jsonify({
@@ -1724,20 +4122,72 @@ def api_monitoring_logs():
             'message': f'获取日志失败: {str(e)}'
         })
 
+def format_sse(name, data, event_id=None):
+    """格式化一条 SSE 消息"""
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines.append(f'event: {name}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/api/events/stream')
+@login_required
+def api_event_stream():
+    """API: 实时事件推送（SSE）
+    
+    事件: stock_change, notification（带事件序号，可通过 Last-Event-ID 续传）, round_complete
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '')
+    
+    def generate(last_id):
+        sequence = event_broker.sequence
+        if last_id is None:
+            # 新连接只推送之后发生的事件
+            with app.app_context():
+                last_id = db.session.query(db.func.max(Event.id)).scalar() or 0
+        
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        messages = []
+        closes_at = time.monotonic() + SSE_MAX_STREAM_SECONDS
+        while time.monotonic() < closes_at:
+            with app.app_context():
+                rows = db.session.query(Event.id, Event.event_type, Event.product_id, Event.product_name,
+                                        Event.level, Event.message, Event.details, Event.timestamp)\
+                    .filter(Event.id > last_id).order_by(Event.id).limit(SSE_REPLAY_LIMIT).all()
+            for row in rows:
+                yield format_sse(row.event_type, serialize_event(row), row.id)
+                last_id = row.id
+            if len(rows) == SSE_REPLAY_LIMIT:
+                continue
+            # 临时消息在同一时刻写入的事件之后推送（轮次完成排在本轮的库存变化之后）
+            for name, data in messages:
+                yield format_sse(name, data)
+            messages = []
+            
+            if event_broker.wait(sequence, min(SSE_HEARTBEAT_INTERVAL, max(0, closes_at - time.monotonic()))) == sequence:
+                yield ': heartbeat\n\n'
+                continue
+            sequence, messages = event_broker.ephemeral_since(sequence)
+    
+    return Response(generate(int(last_event_id) if last_event_id.isdigit() else None),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/clear_logs', methods=['POST'])
 @app.route('/api/clear_logs', methods=['POST'])
 @login_required
 def clear_logs():
     """清除所有日志"""
     try:
-        with db_lock:
-            # 删除所有库存历史记录
-            history_deleted = StockHistory.query.delete()
-            
-            # 删除所有通知记录
-            notification_deleted = NotificationLog.query.delete()
-            
-            db.session.commit()
+        # 分批删除所有库存历史记录及其汇总，期间监控仍可写入
+        history_deleted = delete_in_chunks(StockHistory)
+        delete_in_chunks(StockRollup)
+        
+        # 删除所有通知记录
+        notification_deleted = delete_in_chunks(NotificationLog)
+        delete_in_chunks(Event)
+        data_versions.bump('events')
+        
+        incremental_vacuum()
         
         total_deleted = history_deleted + notification_deleted
         
@@ -1759,20 +4209,21 @@ def clear_logs():
 def toggle_product_status(product_id):
     """切换商品监控状态"""
     try:
-        with db_lock:
-            product = Product.query.get_or_404(product_id)
-            product.is_active = not product.is_active
-            db.session.commit()
-            
-            status_text = "启用" if product.is_active else "暂停"
-            logger.info(f"商品 {product.name} 监控状态已{status_text}")
-            
-            return jsonify({
-                'success': True,
-                'message': f'商品 "{product.name}" 监控已{status_text}',
-                'is_active': product.is_active
-            })
-            
+        product = Product.query.get_or_404(product_id)
+        product.is_active = not product.is_active
+        product.version = (product.version or 0) + 1
+        db.session.commit()
+        dashboard_stats.set_product(product)
+        
+        status_text = "启用" if product.is_active else "暂停"
+        logger.info(f"商品 {product.name} 监控状态已{status_text}")
+        
+        return jsonify({
+            'success': True,
+            'message': f'商品 "{product.name}" 监控已{status_text}',
+            'is_active': product.is_active
+        })
+        
     except Exception as e:
         db.session.rollback()
         logger.error(f"切换商品状态失败: {e}")
@@ -1781,6 +4232,22 @@ def toggle_product_status(product_id):
             'message': str(e)
         }), 500
 
+@app.route('/api/preview_template', methods=['POST'])
+@login_required
+def preview_template():
+    """校验通知模板并用示例数据渲染"""
+    data = request.get_json(silent=True) or {}
+    notification_type = data.get('notification_type', 'restock')
+    if notification_type not in TEMPLATE_SAMPLES:
+        return jsonify({'success': False, 'message': f'未知的通知类型: {notification_type}'}), 400
+    
+    variables = dict(TEMPLATE_SAMPLES[notification_type], check_time=get_internet_time().strftime('%Y-%m-%d %H:%M:%S'))
+    try:
+        message = render_template_message(data.get('template') or DEFAULT_NOTIFICATION_TEMPLATES[notification_type], variables)
+    except TemplateError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'message': message})
+
 @app.route('/test_notification', methods=['POST'])
 @app.route('/api/test_notification', methods=['POST'])
 @login_required
@@ -1810,21 +4277,14 @@ def test_notification():
         
         test_product = TestProduct()
         
-        results = []
-        total_success = 0
+        # 收集需要测试的通知渠道 (类型, 聊天ID)
+        targets = []
         
         # 根据类型测试对应的通知渠道
         if test_type == 'channel':
             # 只测试频道通知
             if config.channel_id and config.channel_enabled:
-                success = notifier._send_to_chat(config.telegram_bot_token, config.channel_id, test_message, test_product)
-                results.append({
-                    'type': '频道消息',
-                    'target': config.channel_id,
-                    'success': success
-                })
-                if success:
-                    total_success += 1
+                targets.append(('频道消息', config.channel_id))
             else:
                 return jsonify({
                     'success': False,
@@ -1834,14 +4294,7 @@ def test_notification():
         elif test_type == 'group':
             # 只测试群组通知
             if config.group_id and config.group_enabled:
-                success = notifier._send_to_chat(config.telegram_bot_token, config.group_id, test_message, test_product)
-                results.append({
-                    'type': '群组消息',
-                    'target': config.group_id,
-                    'success': success
-                })
-                if success:
-                    total_success += 1
+                targets.append(('群组消息', config.group_id))
             else:
                 return jsonify({
                     'success': False,
@@ -1850,19 +4303,9 @@ def test_notification():
                 
         elif test_type == 'user':
             # 测试个人通知
-            sent_any = False
             if hasattr(config, 'user_id') and hasattr(config, 'user_enabled') and config.user_id and config.user_enabled:
-                success = notifier._send_to_chat(config.telegram_bot_token, config.user_id, test_message, test_product)
-                results.append({
-                    'type': '个人消息',
-                    'target': config.user_id,
-                    'success': success
-                })
-                if success:
-                    total_success += 1
-                sent_any = True
-            
-            if not sent_any:
+                targets.append(('个人消息', config.user_id))
+            else:
                 return jsonify({
                     'success': False,
                     'message': '个人通知未启用或未配置用户ID'
@@ -1871,47 +4314,32 @@ def test_notification():
             # 测试所有已启用的通知渠道
             # 测试个人通知（兼容两个字段）
             if config.personal_chat_id and config.personal_enabled:
-                success = notifier._send_to_chat(config.telegram_bot_token, config.personal_chat_id, test_message, test_product)
-                results.append({
-                    'type': '个人消息',
-                    'target': config.personal_chat_id,
-                    'success': success
-                })
-                if success:
-                    total_success += 1
+                targets.append(('个人消息', config.personal_chat_id))
             
             # 测试用户通知（新字段）
             if hasattr(config, 'user_id') and hasattr(config, 'user_enabled') and config.user_id and config.user_enabled:
-                success = notifier._send_to_chat(config.telegram_bot_token, config.user_id, test_message, test_product)
-                results.append({
-                    'type': '用户消息',
-                    'target': config.user_id,
-                    'success': success
-                })
-                if success:
-                    total_success += 1
+                targets.append(('用户消息', config.user_id))
             
             # 测试群组通知
             if config.group_id and config.group_enabled:
-                success = notifier._send_to_chat(config.telegram_bot_token, config.group_id, test_message, test_product)
-                results.append({
-                    'type': '群组消息',
-                    'target': config.group_id,
-                    'success': success
-                })
-                if success:
-                    total_success += 1
+                targets.append(('群组消息', config.group_id))
             
             # 测试频道通知
             if config.channel_id and config.channel_enabled:
-                success = notifier._send_to_chat(config.telegram_bot_token, config.channel_id, test_message, test_product)
-                results.append({
-                    'type': '频道消息',
-                    'target': config.channel_id,
-                    'success': success
-                })
-                if success:
-                    total_success += 1
+                targets.append(('频道消息', config.channel_id))
+        
+        # 各渠道并行发送
+        reply_markup = notifier._build_reply_markup(test_product)
+        sent = telegram.send_many(config.telegram_bot_token,
+                                  [(chat_id, test_message, reply_markup) for _, chat_id in targets])
+        results = [{
+            'type': target_type,
+            'target': chat_id,
+            'success': result.ok,
+            'latency_ms': round(result.latency * 1000, 1),
+            'error': result.error
+        } for (target_type, chat_id), result in zip(targets, sent)]
+        total_success = sum(1 for result in sent if result.ok)
         
         if not results:
             return jsonify({
@@ -1939,26 +4367,29 @@ if __name__ == '__main__':
     
     with app.app_context():
         db.create_all()
+        run_schema_migrations()
         logger.info("数据库初始化完成")
         
         # 初始化默认管理员用户
         init_default_user()
+        
+        # 加载仪表盘统计
+        dashboard_stats.rebuild()
+        
+        # 恢复上次未发送完成的通知
+        outbox.recover()
+    
+    # 启动时间同步（后台进行，不阻塞启动）
+    clock.start()
     
     # 启动调度器
     try:
-        with app.app_context():
-            config = NotificationConfig.query.first()
-            interval_seconds = config.check_interval if config else 120
-        
-        scheduler.add_job(
-            func=monitor_all_products_v2,
-            trigger="interval",
-            seconds=interval_seconds,
-            id='monitor_job_v2'
-        )
+        update_scheduler_v2()
+        schedule_retention_job()
+        schedule_outbox_job()
         scheduler.start()
         
-        logger.info(f"定时任务启动完成，间隔: {interval_seconds} 秒")
+        logger.info(f"定时任务启动完成，调度周期: {SCHEDULER_TICK_SECONDS} 秒")
         logger.info("系统启动成功！访问 http://localhost:5000")
     except Exception as e:
         logger.error(f"启动调度器失败: {e}")
@@ -110,7 +110,7 @@ check_env() {
 	print_banner
 	INFO "开始检测系统与Python依赖..."
 	local -a BIN_LIST=(python3 python pip3 pip sqlite3 curl wget git)
-	local -a PY_MODS=(Flask flask_sqlalchemy requests apscheduler bs4 telegram lxml werkzeug pytz ntplib)
+	local -a PY_MODS=(Flask flask_sqlalchemy requests apscheduler bs4 telegram lxml cssselect werkzeug pytz ntplib numpy)
 
 	echo -e "\n${C_BLUE}系统命令检测:${C_RESET}"
 	for b in "${BIN_LIST[@]}"; do